@@ -1,24 +1,33 @@
 import os
-import jwt
+import json
 import logging
 import clients.database_client as database_client
 from auth import (
     require_azure_auth,
     token_required,
     exchange_azure_token,
+    create_app_token,
+    token_cache_stats,
+    jwks_stats,
+)
+from clients.registry import search_cache_stats
+from modules.chatbot import get_chatbot, prompt_assembly_stats, response_cache_stats
+from modules.password_hasher import PasswordHasherBusy
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    request,
+    session,
+    make_response,
+    stream_with_context,
 )
-from modules.chatbot import OpenAIChatbot
-from flask import Flask, jsonify, request, session, make_response
 from flask_session import Session
 from dotenv import load_dotenv
 from flask_cors import CORS
-from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash
 import tiktoken
 
 
-ADMIN_USER_ID = 1
-
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -28,6 +37,11 @@ load_dotenv()
 
 db = database_client.DatabaseClient()
 
+# Create or upgrade the tables the backend owns before serving requests. Disable this
+# to run the migrations separately with `python -m clients.schema`.
+if os.environ.get("schema-auto-migrate", "true").lower() != "false":
+    db.ensure_schema()
+
 app = Flask(__name__)
 
 # Configure Session
@@ -45,6 +59,31 @@ CORS(app, supports_credentials=True)
 TOKEN_ENCODER = tiktoken.encoding_for_model("gpt-4o")
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Ask the client to retry when password hashing is saturated"""
+    logging.warning(f"Password hashing unavailable: {e}")
+    response = jsonify(
+        {"status": "error", "message": "Server is busy, please try again shortly"}
+    )
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
+def current_student_id():
+    """Return the authenticated student's id from the verified token claims, or None.
+
+    Azure AD tokens and app tokens issued by older versions have no student_id
+    claim; their users have to exchange or log in again for a new app token.
+    """
+    return request.current_user.get("student_id")
+
+
+def is_admin():
+    """Return True if the authenticated user has the admin role"""
+    return request.current_user.get("role") == "admin"
+
+
 @app.route("/api/health", methods=["GET"])
 def health_check():
     """Simple health check endpoint"""
@@ -76,8 +115,15 @@ def register():
     email = data.get("email")
     name = data.get("name")
 
-    # Check if user already exists
-    if db.email_already_exist(email):
+    # Check before hashing, so duplicate registrations do not tie up the hash pool;
+    # get_or_create_student still catches a concurrent registration
+    student_id, created = None, False
+    if not db.email_already_exist(email):
+        # Hash the password before storing
+        hashed_password = db.password_hasher.hash(data.get("password"))
+        student_id, created = db.get_or_create_student(name, email, hashed_password)
+
+    if not created:
         return (
             jsonify(
                 {"status": "error", "message": "User with this email already exists"}
@@ -85,18 +131,8 @@ def register():
             409,
         )
 
-    # Hash the password before storing
-    hashed_password = generate_password_hash(data.get("password"))
-
-    student = db.add_new_student(name, email, hashed_password)
-
     # Generate JWT token, similar to login endpoint
-    token_expiry = datetime.now() + timedelta(hours=24)
-    token = jwt.encode(
-        {"email": email, "name": name, "exp": token_expiry},
-        app.config["SECRET_KEY"],
-        algorithm="HS256",
-    )
+    token = create_app_token(email, name, student_id)
 
     response = make_response(
         jsonify(
@@ -105,24 +141,15 @@ def register():
                 "message": "User registered successfully",
                 "token": token,
                 "user": {
-                    "email": student.email,
-                    "name": student.name,
-                    "student_id": student.student_id,
+                    "email": email,
+                    "name": name,
+                    "student_id": student_id,
                 },
             }
         ),
         201,
     )
 
-    # Set user_id in http-only cookie
-    response.set_cookie(
-        "student_id",
-        str(student.student_id),
-        httponly=True,
-        samesite="Lax",
-        secure=False,
-    )
-
     return response
 
 
@@ -159,12 +186,7 @@ def login():
     student_name = student_info.name
 
     # Generate JWT token
-    token_expiry = datetime.now() + timedelta(hours=24)
-    token = jwt.encode(
-        {"email": email, "name": student_name, "exp": token_expiry},
-        app.config["SECRET_KEY"],
-        algorithm="HS256",
-    )
+    token = create_app_token(email, student_name, student_id)
 
     response = make_response(
         jsonify(
@@ -181,11 +203,6 @@ def login():
         )
     )
 
-    # Set user_id in http-only to securely determine the current user
-    response.set_cookie(
-        "student_id", str(student_id), httponly=True, samesite="Lax", secure=False
-    )
-
     return response
 
 
@@ -196,7 +213,7 @@ def logout():
         jsonify({"status": "success", "message": "Logged out successfully"})
     )
 
-    # Clear all session cookies
+    # Clear all session cookies, including the student_id cookie of older versions
     response.delete_cookie("student_id")
     response.delete_cookie("flask_chat_session")
 
@@ -224,30 +241,22 @@ def azure_login():
 def chat():
     data = request.json
     prompt = data.get("message", "")
-    chatbot = OpenAIChatbot()
-
-    # Get student_id from cookie and ensure it's an integer
-    student_id = request.cookies.get("student_id")
+    chatbot = get_chatbot()
 
-    # Verify student_id is valid
-    if not student_id:
-        logging.error("Chat error: No student_id in cookies")
+    # Get student_id from the token claims
+    student_id = current_student_id()
+    if student_id is None:
+        logging.error("Chat error: No valid student_id for the current user")
         return jsonify({"error": "Authentication required. Please log in again."}), 401
 
-    try:
-        # Convert to integer to make sure it's valid
-        student_id = int(student_id)
-    except (TypeError, ValueError):
-        logging.error(f"Chat error: Invalid student_id: {student_id}")
-        return jsonify({"error": "Invalid user session. Please log in again."}), 401
-
     # Check if user has reached their token limit
     # First, we need to estimate tokens for this request
     input_tokens = len(TOKEN_ENCODER.encode(prompt))
     estimated_tokens = input_tokens * 4  # Rough estimate for total (input + output)
 
-    # Check if user can use these tokens
-    if not db.can_user_use_tokens(student_id, estimated_tokens):
+    # Hold the estimate against the user's quota until the actual usage is known
+    reservation_id = db.reserve_tokens(student_id, estimated_tokens)
+    if reservation_id is None:
         return (
             jsonify(
                 {
@@ -260,6 +269,12 @@ def chat():
 
     chat_history = session.get("chat_history", [])
 
+    # Stream the answer as Server-Sent Events if requested
+    if data.get("stream") or "text/event-stream" in request.headers.get("Accept", ""):
+        return stream_chat(
+            chatbot, prompt, student_id, chat_history, input_tokens, reservation_id
+        )
+
     try:
         response_content = chatbot.generate_response(prompt, student_id, chat_history)
 
@@ -284,7 +299,7 @@ def chat():
         # Calculate and record token usage
         output_tokens = len(TOKEN_ENCODER.encode(response_content))
         total_tokens = input_tokens + output_tokens
-        db.add_token_usage(student_id, total_tokens)
+        db.commit_token_reservation(reservation_id, student_id, total_tokens)
 
         print(
             f"Student {student_id} used {total_tokens} tokens.",
@@ -297,6 +312,7 @@ def chat():
         # Even if the request fails, we should still track the input tokens
         # Only track tokens if student_id is valid
         if isinstance(student_id, int):
+            db.release_token_reservation(reservation_id)
             db.add_token_usage(student_id, input_tokens)
             print(
                 f"Student {student_id} used {input_tokens} tokens (failed request).",
@@ -307,6 +323,61 @@ def chat():
         return jsonify({"error": f"Error processing request: {str(e)}"}), 500
 
 
+def stream_chat(
+    chatbot, prompt, student_id, chat_history, input_tokens, reservation_id
+):
+    """Relay the chatbot's answer as Server-Sent Events.
+
+    Each event carries a piece of the answer; a final "done" or "error" event ends
+    the stream. Token usage and the chat history are saved when the stream ends,
+    also when the client disconnects early.
+    """
+
+    def generate():
+        chunks = []
+        try:
+            for delta in chatbot.stream_response(prompt, student_id, chat_history):
+                chunks.append(delta)
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            logging.error(f"Chat stream error: {str(e)}")
+            error = json.dumps({"error": f"Error processing request: {str(e)}"})
+            yield f"event: error\ndata: {error}\n\n"
+        finally:
+            response_content = "".join(chunks)
+
+            # Replace the reservation with the tokens actually used; the input
+            # tokens are charged even if nothing was generated
+            output_tokens = len(TOKEN_ENCODER.encode(response_content))
+            total_tokens = input_tokens + output_tokens
+            db.commit_token_reservation(reservation_id, student_id, total_tokens)
+            print(f"Student {student_id} used {total_tokens} tokens.", flush=True)
+
+            if response_content:
+                chat_history.append({"role": "user", "content": prompt})
+                chat_history.append({"role": "assistant", "content": response_content})
+                session["chat_history"] = chat_history[-10:]
+                session.modified = True
+
+                # The response has already been sent, so save the session directly
+                app.session_interface.save_session(app, session, Response())
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.set_cookie(
+        "flask_chat_session",
+        session.sid,
+        httponly=True,
+        samesite="Lax",
+        secure=False,
+    )
+    return response
+
+
 @app.route("/api/protected", methods=["GET"])
 @require_azure_auth
 def protected_endpoint():
@@ -349,27 +420,22 @@ def get_user_info():
 @token_required
 def get_student_courses():
     try:
-        student_id = request.cookies.get("student_id")
-        if not student_id:
+        student_id = current_student_id()
+        if student_id is None:
             return (
                 jsonify({"error": "Authentication required. Please log in again."}),
                 401,
             )
 
-        try:
-            # Convert to integer to make sure it's valid
-            student_id = int(student_id)
-        except (TypeError, ValueError):
-            return jsonify({"error": "Invalid session. Please log in again."}), 401
-
         student_info = db.get_student_info(student_id)
         if not student_info:
             return jsonify({"error": "Student not found"}), 404
 
+        program = student_info.program
         program_data = {
-            "id": student_info.program.get("program_id", 0),
-            "name": student_info.program.get("program_name", ""),
-            "european_credits": student_info.program.get("program_ec", 180),
+            "id": program.program_id if program else 0,
+            "name": program.name if program else "",
+            "european_credits": program.european_credits if program else 180,
         }
 
         # Format the courses data from student_info
@@ -377,15 +443,15 @@ def get_student_courses():
         for i, course in enumerate(student_info.courses):
             formatted_grade = {
                 "id": i + 1,
-                "course_id": course["id"],
-                "grade": course["grade"],
-                "feedback": course.get("feedback", ""),
-                "created_at": str(course["created_at"]),
+                "course_id": course.course_id,
+                "grade": course.grade,
+                "feedback": course.feedback,
+                "created_at": str(course.created_at),
                 "course": {
-                    "id": course["id"],
-                    "name": course["course_name"],
-                    "european_credits": course["ec"],
-                    "program_id": student_info.program.get("program_id", 0),
+                    "id": course.course_id,
+                    "name": course.name,
+                    "european_credits": course.european_credits,
+                    "program_id": program_data["id"],
                 },
             }
             formatted_grades.append(formatted_grade)
@@ -413,18 +479,14 @@ def get_student_courses():
 def get_token_usage():
     """Get token usage for the current user"""
     try:
-        student_id = request.cookies.get("student_id")
-        if not student_id:
+        student_id = current_student_id()
+        if student_id is None:
             return jsonify({"error": "User not authenticated"}), 401
 
-        try:
-            student_id = int(student_id)
-        except (TypeError, ValueError):
-            return jsonify({"error": "Invalid student ID"}), 400
-
-        # Get current month's usage and cache it
-        current_usage = db.get_user_monthly_usage(student_id)
-        user_limit = db.get_user_token_limit(student_id)
+        # Get current month's usage and limit in one round trip
+        quota = db.get_quota_snapshot(student_id)
+        current_usage = quota["usage"]
+        user_limit = quota["limit"]
 
         # Calculate percentage used
         percentage_used = 0
@@ -457,26 +519,53 @@ def get_token_usage():
 def get_admin_token_usage():
     """Get token usage for all users (admin only)"""
     try:
-        student_id = request.cookies.get("student_id")
-        if str(student_id) != str(ADMIN_USER_ID):
+        if not is_admin():
             return jsonify({"error": "Not authorized"}), 403
 
         # Get year and month from query params, if provided
         year = request.args.get("year", type=int)
         month = request.args.get("month", type=int)
 
-        # Get usage data for all users
-        usage_data = db.get_monthly_token_usage(year, month)
+        # Optional keyset pagination: students with an id after after_student_id
+        after_student_id = request.args.get("after_student_id", type=int)
+        limit = request.args.get("limit", type=int)
+        if limit is not None and limit <= 0:
+            return jsonify({"error": "Limit must be a positive number"}), 400
 
         # Get global limit and active users count
         global_limit = db.get_global_token_limit()
         active_users = db.get_active_users_count()
 
+        # Stream one JSON object per line instead of building the whole list
+        if (
+            request.args.get("format") == "ndjson"
+            or request.accept_mimetypes.best == "application/x-ndjson"
+        ):
+            rows = db.iter_monthly_token_usage(year, month, after_student_id, limit)
+            response = Response(
+                stream_with_context(json.dumps(row) + "\n" for row in rows),
+                mimetype="application/x-ndjson",
+            )
+            response.headers["X-Global-Limit"] = str(global_limit)
+            response.headers["X-Active-Users"] = str(active_users)
+            return response
+
+        # Get usage data for all users
+        usage_data = db.get_monthly_token_usage(year, month, after_student_id, limit)
+
+        # Cursor for the next page, if this page is full
+        next_after_student_id = (
+            usage_data[-1]["student_id"]
+            if limit is not None and len(usage_data) == limit
+            else None
+        )
+
         return jsonify(
             {
                 "global_limit": global_limit,
                 "active_users": active_users,
                 "usage_data": usage_data,
+                "next_after_student_id": next_after_student_id,
             }
         )
 
@@ -490,8 +579,7 @@ def get_admin_token_usage():
 def get_token_limit():
     """Get the current global token limit (admin only)"""
     try:
-        student_id = request.cookies.get("student_id")
-        if str(student_id) != str(ADMIN_USER_ID):
+        if not is_admin():
             return jsonify({"error": "Not authorized"}), 403
 
         # Get global limit
@@ -524,8 +612,7 @@ def get_token_limit():
 def set_token_limit():
     """Set the global token limit (admin only)"""
     try:
-        student_id = request.cookies.get("student_id")
-        if str(student_id) != str(ADMIN_USER_ID):
+        if not is_admin():
             return jsonify({"error": "Not authorized"}), 403
 
         data = request.json
@@ -564,12 +651,36 @@ def set_token_limit():
 @app.route("/api/metrics", methods=["GET"])
 @token_required
 def metrics():
-    if request.cookies.get("student_id") != str(ADMIN_USER_ID):
+    if not is_admin():
         return jsonify({"error": "Not authorized"}), 403
 
     return jsonify(db.get_user_token_usage())
 
 
+@app.route("/api/admin/db/stats", methods=["GET"])
+@token_required
+def db_stats():
+    """Get database connection pool, cache, usage buffer and query metrics (admin only)"""
+    if not is_admin():
+        return jsonify({"error": "Not authorized"}), 403
+
+    return jsonify(
+        {
+            "pool": db.pool_stats(),
+            "settings_cache": db.settings_cache_stats(),
+            "profile_cache": db.profile_cache_stats(),
+            "usage_recorder": db.usage_recorder_stats(),
+            "queries": db.query_stats(),
+            "token_cache": token_cache_stats(),
+            "jwks": jwks_stats(),
+            "password_hasher": db.password_hasher.stats(),
+            "search_cache": search_cache_stats(),
+            "response_cache": response_cache_stats(),
+            "prompt_tokens": prompt_assembly_stats(),
+        }
+    )
+
+
 # Endpoint to update user email
 @app.route("/api/student/update-email", methods=["PUT"])
 @token_required
@@ -610,6 +721,13 @@ def update_email():
                 403,
             )
 
+        student_id = current_student_id()
+        if student_id is None:
+            return (
+                jsonify({"error": "Authentication required. Please log in again."}),
+                401,
+            )
+
         # Check if the new email already exists
         if db.email_already_exist(new_email) and new_email != current_email:
             return (
@@ -631,16 +749,7 @@ def update_email():
             )
 
         # Generate new JWT token with updated email
-        token_expiry = datetime.now() + timedelta(hours=24)
-        token = jwt.encode(
-            {
-                "email": new_email,
-                "name": request.current_user["name"],
-                "exp": token_expiry,
-            },
-            app.config["SECRET_KEY"],
-            algorithm="HS256",
-        )
+        token = create_app_token(new_email, request.current_user["name"], student_id)
 
         return jsonify(
             {
@@ -651,6 +760,8 @@ def update_email():
             }
         )
 
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         logging.error(f"Error updating email: {e}")
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
@@ -706,7 +817,7 @@ def update_password():
             )
 
         # Hash the new password
-        hashed_password = generate_password_hash(new_password)
+        hashed_password = db.password_hasher.hash(new_password)
 
         # Update the password in the database
         success = db.update_student_password(email, hashed_password)
@@ -721,6 +832,8 @@ def update_password():
             {"status": "success", "message": "Password updated successfully"}
         )
 
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         logging.error(f"Error updating password: {e}")
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
@@ -1,12 +1,13 @@
 from flask import request, jsonify, current_app, make_response
 import jwt
-import requests
 import os
 import logging
 from functools import wraps
-import json
+import hashlib
+import time
 from datetime import datetime, timedelta
-from jwt.algorithms import RSAAlgorithm
+from modules.cache import TTLCache
+from modules.jwks import JWKSKeyStore
 
 # Configure logging
 logging.basicConfig(
@@ -20,41 +21,61 @@ AUTHORITY_URL = f"https://login.microsoftonline.com/{TENANT_ID}"
 JWKS_URL = f"{AUTHORITY_URL}/discovery/v2.0/keys"
 ISSUER = f"https://login.microsoftonline.com/{TENANT_ID}/v2.0"
 
-# Cache for JWKS keys
-jwks_cache = {"keys": None, "last_updated": None}
+# Student id of the administrator account
+ADMIN_USER_ID = 1
 
-# Cache for validated tokens to prevent excessive validation
-token_cache = {}
+# Parsed JWKS signing keys by kid, refreshed in the background
+jwks_keys = JWKSKeyStore(
+    JWKS_URL,
+    max_age=float(os.environ.get("AZURE_JWKS_MAX_AGE", 86400)),
+    min_refresh_interval=float(os.environ.get("AZURE_JWKS_MIN_REFRESH_INTERVAL", 60)),
+)
 
+# Cache for validated tokens to prevent excessive validation, keyed by token digest
+token_cache = TTLCache(
+    ttl=float(os.environ.get("AZURE_TOKEN_CACHE_TTL", 300)),
+    maxsize=int(os.environ.get("AZURE_TOKEN_CACHE_SIZE", 10000)),
+)
+
+# Decoded claims of our own HS256 tokens, keyed by token digest
+app_token_cache = TTLCache(
+    ttl=float(os.environ.get("APP_TOKEN_CACHE_TTL", 300)),
+    maxsize=int(os.environ.get("APP_TOKEN_CACHE_SIZE", 10000)),
+)
+
+
+def _token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
 
-def get_jwks():
-    """
-    Get JWKS keys from Microsoft, with caching
-    """
-    global jwks_cache
-
-    # If cache is older than 24 hours or doesn't exist, refresh it
-    if (
-        not jwks_cache["last_updated"]
-        or (datetime.now() - jwks_cache["last_updated"]).total_seconds() > 86400
-    ):
-        logging.info("Fetching new JWKS keys from Microsoft")
-        try:
-            response = requests.get(JWKS_URL, timeout=15)
-            response.raise_for_status()  # Raises an HTTPError for bad responses
-            jwks_cache["keys"] = response.json()["keys"]
-            jwks_cache["last_updated"] = datetime.now()
-        except Exception as e:
-            logging.error(f"Error fetching JWKS keys: {e}")
-            if not jwks_cache["keys"]:  # Only raise if we don't have any cached keys
-                raise
 
-    return jwks_cache["keys"]
+def token_cache_stats() -> dict:
+    """Return hit, miss and eviction counters of the validated token caches."""
+    return {"azure": token_cache.stats(), "internal": app_token_cache.stats()}
 
 
-def verify_azure_token(token=None):
+def jwks_stats() -> dict:
+    """Return the number and age of the cached JWKS signing keys."""
+    return jwks_keys.stats()
+
+
+def create_app_token(email: str, name: str, student_id: int, **claims) -> str:
+    """
+    Issue our own HS256 token, valid for 24 hours, carrying the user's identity and role
     """
-    Verify an Azure AD token
+    payload = {
+        "email": email,
+        "name": name,
+        "student_id": student_id,
+        "role": "admin" if student_id == ADMIN_USER_ID else "student",
+        "exp": datetime.utcnow() + timedelta(hours=24),
+        **claims,
+    }
+    return jwt.encode(payload, current_app.config["SECRET_KEY"], algorithm="HS256")
+
+
+def verify_azure_token(token=None, header=None):
+    """
+    Verify an Azure AD token, optionally with its already parsed unverified header
     """
     if not token:
         auth_header = request.headers.get("Authorization", None)
@@ -63,14 +84,15 @@ def verify_azure_token(token=None):
         token = auth_header.split(" ")[1]
 
     # Check token cache first
-    cached_result = token_cache.get(token)
-    if cached_result:
-        if cached_result["exp"] > datetime.utcnow():
-            return cached_result["user_info"]
+    token_key = _token_digest(token)
+    cached_user_info = token_cache.get(token_key)
+    if cached_user_info is not None:
+        return cached_user_info
 
     try:
         # Get token header to extract kid
-        header = jwt.get_unverified_header(token)
+        if header is None:
+            header = jwt.get_unverified_header(token)
         kid = header.get("kid")
 
         if not kid:
@@ -78,12 +100,7 @@ def verify_azure_token(token=None):
             return jsonify({"error": "Invalid token format: no kid"}), 401
 
         # Get the signing key
-        keys = get_jwks()
-        signing_key = None
-        for key in keys:
-            if key["kid"] == kid:
-                signing_key = RSAAlgorithm.from_jwk(json.dumps(key))
-                break
+        signing_key = jwks_keys.get_key(kid)
 
         if not signing_key:
             logging.warning(f"No matching key found for kid: {kid}")
@@ -115,11 +132,12 @@ def verify_azure_token(token=None):
             "auth_source": "azure_ad",
         }
 
-        # Cache the validated token
-        token_cache[token] = {
-            "exp": datetime.utcnow() + timedelta(minutes=5),  # Cache for 5 minutes
-            "user_info": user_info,
-        }
+        # Cache the validated token, but never beyond its own expiry
+        ttl = token_cache.ttl
+        if "exp" in decoded:
+            ttl = min(ttl, decoded["exp"] - time.time())
+        if ttl > 0:
+            token_cache.set(token_key, user_info, ttl=ttl)
 
         return user_info
 
@@ -182,34 +200,42 @@ def token_required(f):
             return jsonify({"error": "Token is empty"}), 401
 
         try:
-            # Check if token is an Azure token (they start with "ey" typically)
-            if token.startswith("ey"):
-                try:
-                    # Try to validate as an Azure token first
-                    azure_user = verify_azure_token(token)
-                    if not isinstance(azure_user, tuple):
-                        # If successful, set the user info
-                        request.current_user = {
-                            "email": azure_user.get("email", "unknown"),
-                            "name": azure_user.get("name", "Azure User"),
-                            "auth_source": "azure_ad",
-                        }
-                        return f(*args, **kwargs)
-                except Exception as e:
-                    logging.warning(
-                        f"Azure token validation failed, trying app token: {e}"
-                    )
-
-            # Verify our own token format
-            data = jwt.decode(
-                token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
-            )
+            # Our own tokens are HS256; anything else must be an Azure AD token
+            header = jwt.get_unverified_header(token)
+            if header.get("alg") != "HS256":
+                azure_user = verify_azure_token(token, header)
+                if isinstance(azure_user, tuple):  # Error response
+                    return azure_user
+
+                request.current_user = {
+                    "email": azure_user.get("email", "unknown"),
+                    "name": azure_user.get("name", "Azure User"),
+                    "auth_source": "azure_ad",
+                    "student_id": None,
+                    "role": "student",
+                }
+                return f(*args, **kwargs)
+
+            # Verify our own token, unless it was verified before and has not expired
+            token_key = _token_digest(token)
+            data = app_token_cache.get(token_key)
+            if data is None:
+                data = jwt.decode(
+                    token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
+                )
+                ttl = app_token_cache.ttl
+                if "exp" in data:
+                    ttl = min(ttl, data["exp"] - time.time())
+                if ttl > 0:
+                    app_token_cache.set(token_key, data, ttl=ttl)
 
             # Add user data to the request
             request.current_user = {
                 "email": data.get("email", "unknown"),
                 "name": data.get("name", "unknown"),
                 "auth_source": "internal",
+                "student_id": data.get("student_id"),
+                "role": data.get("role", "student"),
             }
 
         except jwt.ExpiredSignatureError:
@@ -258,27 +284,12 @@ def exchange_azure_token(azure_token=None):
 
         db = database_client.DatabaseClient()
 
-        # Check if user exists, if not create them
-        student_id = None
-        if db.email_already_exist(user_email):
-            # Get existing student info
-            student_id = db.get_student_id_by_email(user_email)
-        else:
-            # Create new student without password for SSO users
-            student = db.add_new_student(user_name, user_email, None)
-            student_id = student.student_id
+        # Get the existing student, or create one without password for SSO users
+        student_id, _ = db.get_or_create_student(user_name, user_email, None)
 
         # Generate our application token
-        token_expiry = datetime.utcnow() + timedelta(hours=24)
-        app_token = jwt.encode(
-            {
-                "email": user_email,
-                "name": user_name,
-                "auth_source": "azure_ad",
-                "exp": token_expiry,
-            },
-            current_app.config["SECRET_KEY"],
-            algorithm="HS256",
+        app_token = create_app_token(
+            user_email, user_name, student_id, auth_source="azure_ad"
         )
 
         # Create response with token and user info
@@ -296,11 +307,6 @@ def exchange_azure_token(azure_token=None):
             )
         )
 
-        # Set student_id cookie
-        response.set_cookie(
-            "student_id", str(student_id), httponly=True, samesite="Lax", secure=False
-        )
-
         return response
 
     except Exception as e:
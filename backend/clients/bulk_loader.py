@@ -0,0 +1,153 @@
+"""
+Bulk loader for programs, courses, students and grades from CSV or JSONL files.
+
+Load a cohort from the command line; files are loaded in dependency order:
+
+    python -m clients.bulk_loader --programs programs.csv --courses courses.csv \
+        --students students.jsonl --grades grades.csv
+
+Columns per kind of record (extra columns are ignored):
+
+    programs: name, european_credits
+    courses:  name, european_credits, program
+    students: name, email, password_hash, program
+    grades:   email, course, grade, feedback
+
+Programs and courses are matched by name, students by email. Existing records and
+grades for a course the student already has are skipped, so a file can be loaded
+again after a partial failure.
+"""
+
+import csv
+import json
+import logging
+import os
+import time
+from typing import Iterable, Iterator, Optional
+
+from clients.database_client import DatabaseClient
+
+COLUMNS = {
+    "programs": ("name", "european_credits"),
+    "courses": ("name", "european_credits", "program"),
+    "students": ("name", "email", "password_hash", "program"),
+    "grades": ("email", "course", "grade", "feedback"),
+}
+
+# Columns that identify a record; duplicates within a batch keep the first row
+KEYS = {
+    "programs": ("name",),
+    "courses": ("name",),
+    "students": ("email",),
+    "grades": ("email", "course"),
+}
+
+INTEGER_COLUMNS = {"european_credits", "grade"}
+
+LOAD_ORDER = ("programs", "courses", "students", "grades")
+
+
+def read_records(path: str, file_format: str = None) -> Iterator[dict]:
+    """Yield the records of a CSV or JSONL file as dicts.
+
+    The format is taken from the file extension unless ``file_format`` is given.
+    """
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        file_format = "csv" if extension == ".csv" else "jsonl"
+
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+        elif file_format in ("jsonl", "ndjson"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Unknown file format '{file_format}'")
+
+
+def _value(record: dict, column: str):
+    value = record.get(column)
+    if value == "":
+        return None
+    if value is not None and column in INTEGER_COLUMNS:
+        return int(value)
+    return value
+
+
+class BulkLoader:
+    """Load records into the database in batches through DatabaseClient.bulk_load."""
+
+    def __init__(self, db: DatabaseClient = None, batch_size: int = 5000):
+        self.db = db or DatabaseClient()
+        self.batch_size = batch_size
+
+    def load(self, kind: str, records: Iterable[dict]) -> dict:
+        """Load ``records`` of ``kind`` and return counts and throughput."""
+        columns = COLUMNS[kind]
+        key_indexes = [columns.index(column) for column in KEYS[kind]]
+
+        report = {"kind": kind, "read": 0, "inserted": 0, "batches": 0}
+        start = time.perf_counter()
+
+        batch = {}
+        for record in records:
+            row = tuple(_value(record, column) for column in columns)
+            batch.setdefault(tuple(row[i] for i in key_indexes), row)
+            report["read"] += 1
+
+            if len(batch) >= self.batch_size:
+                self._flush(kind, batch, report)
+
+        if batch:
+            self._flush(kind, batch, report)
+
+        seconds = time.perf_counter() - start
+        report["skipped"] = report["read"] - report["inserted"]
+        report["seconds"] = round(seconds, 3)
+        report["rows_per_second"] = round(report["read"] / seconds) if seconds else 0
+        return report
+
+    def _flush(self, kind: str, batch: dict, report: dict):
+        report["inserted"] += self.db.bulk_load(kind, list(batch.values()))
+        report["batches"] += 1
+        batch.clear()
+        logging.info(f"Loaded {report['read']} {kind} so far")
+
+    def load_file(self, kind: str, path: str, file_format: Optional[str] = None):
+        """Load a CSV or JSONL file of ``kind`` records."""
+        return self.load(kind, read_records(path, file_format))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    for kind in LOAD_ORDER:
+        parser.add_argument(f"--{kind}", metavar="FILE", help=f"{kind} CSV or JSONL")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default=None)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    load_dotenv()
+
+    db = DatabaseClient()
+    db.ensure_schema()
+    loader = BulkLoader(db, batch_size=args.batch_size)
+
+    for kind in LOAD_ORDER:
+        path = getattr(args, kind)
+        if path:
+            report = loader.load_file(kind, path, args.format)
+            print(
+                f"{kind}: read {report['read']}, inserted {report['inserted']}, "
+                f"skipped {report['skipped']} in {report['seconds']}s "
+                f"({report['rows_per_second']} rows/s)"
+            )
@@ -0,0 +1,220 @@
+"""
+Bounded, thread-safe pool of database connections shared by all DatabaseClient instances.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+class _PooledConnection:
+    """A raw connection plus the bookkeeping the pool needs to recycle it."""
+
+    __slots__ = ("raw", "created_at", "last_used")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """Pool that hands out one connection per caller and takes it back afterwards.
+
+    Connections are created lazily up to ``max_size``. Callers that find the pool
+    exhausted wait up to ``timeout`` seconds. Connections that sat idle for longer
+    than ``max_idle`` seconds are closed instead of reused, and connections idle for
+    longer than ``ping_interval`` seconds are pinged before being handed out.
+    """
+
+    def __init__(
+        self,
+        connect,
+        max_size: int = 10,
+        timeout: float = 30.0,
+        max_idle: float = 300.0,
+        ping_interval: float = 30.0,
+        ping_query: str = "SELECT 1;",
+    ):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        self.ping_query = ping_query
+
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # Metrics
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._recycled = 0
+        self._discarded = 0
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the ``with`` block.
+
+        The transaction is rolled back if the block raises or is abandoned, e.g. when
+        a generator holding the connection is closed, and the connection is
+        discarded if it cannot be rolled back cleanly.
+        """
+        pooled = self._checkout()
+        try:
+            yield pooled.raw
+        except BaseException:
+            try:
+                pooled.raw.rollback()
+            except Exception:
+                self._discard(pooled)
+                raise
+            self._checkin(pooled)
+            raise
+        else:
+            self._checkin(pooled)
+
+    def _checkout(self) -> _PooledConnection:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(
+                            f"No database connection available after {self.timeout}s"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    pooled = self._idle.pop()
+                else:
+                    pooled = None
+                    # Reserve the slot before connecting outside the lock
+                    self._size += 1
+
+            if pooled is None:
+                try:
+                    pooled = _PooledConnection(self._connect())
+                except Exception:
+                    self._release_slot()
+                    raise
+                with self._cond:
+                    self._created += 1
+            elif not self._is_usable(pooled):
+                continue
+
+            self._record_checkout(time.monotonic() - start, waited)
+            return pooled
+
+    def _is_usable(self, pooled: _PooledConnection) -> bool:
+        """Close idle-expired or broken connections; return whether ``pooled`` can be reused."""
+        idle_for = time.monotonic() - pooled.last_used
+
+        if idle_for > self.max_idle:
+            self._close(pooled.raw)
+            self._release_slot()
+            with self._cond:
+                self._recycled += 1
+            return False
+
+        if idle_for > self.ping_interval:
+            try:
+                cursor = pooled.raw.cursor()
+                try:
+                    cursor.execute(self.ping_query)
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+            except Exception as e:
+                logging.warning(f"Discarding broken database connection: {e}")
+                self._discard(pooled)
+                return False
+
+        return True
+
+    def _checkin(self, pooled: _PooledConnection):
+        pooled.last_used = time.monotonic()
+        with self._cond:
+            if not self._closed:
+                self._idle.append(pooled)
+                self._cond.notify()
+                return
+        self._close(pooled.raw)
+        self._release_slot()
+
+    def _discard(self, pooled: _PooledConnection):
+        self._close(pooled.raw)
+        self._release_slot()
+        with self._cond:
+            self._discarded += 1
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _record_checkout(self, wait_time: float, waited: bool):
+        with self._cond:
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._wait_time_total += wait_time
+            self._wait_time_max = max(self._wait_time_max, wait_time)
+
+    @staticmethod
+    def _close(raw):
+        try:
+            raw.close()
+        except Exception as e:
+            logging.debug(f"Error closing database connection: {e}")
+
+    def close(self):
+        """Close every idle connection. Checked-out connections are closed on return."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            self._close(pooled.raw)
+
+    def stats(self) -> dict:
+        """Return a snapshot of the pool size and checkout wait metrics."""
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_time_total": round(self._wait_time_total, 6),
+                "wait_time_avg": (
+                    round(self._wait_time_total / self._checkouts, 6)
+                    if self._checkouts
+                    else 0.0
+                ),
+                "wait_time_max": round(self._wait_time_max, 6),
+                "created": self._created,
+                "recycled": self._recycled,
+                "discarded": self._discarded,
+            }
@@ -1,30 +1,256 @@
-from typing import Optional
-from modules.student import Student
-from werkzeug.security import check_password_hash
-import pyodbc
+from typing import Optional, Tuple
+from modules.student import Course, Program, Student
+from clients import schema
+from clients.connection_pool import ConnectionPool
+from clients.query_metrics import InstrumentedCursor, QueryMetrics
+from clients.storage import StorageBackend, create_backend
+from clients.usage_recorder import UsageRecorder
+from modules.cache import FileInvalidationChannel, TTLCache
+from modules.password_hasher import PasswordHasher, get_password_hasher
 import os
 import random
-from datetime import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+# Storage backend, connection pool, caches and usage recorder shared by every
+# DatabaseClient in this process
+_shared_backend = None
+_shared_pool = None
+_schema_ready = False
+_shared_settings_cache = None
+_shared_profile_cache = None
+_shared_usage_recorder = None
+_shared_query_metrics = None
+_shared_lock = threading.Lock()
+
+
+def _month_start(year=None, month=None) -> date:
+    """Return the first day of the given month, defaulting to the current month."""
+    if year is None or month is None:
+        current_date = datetime.now()
+        year = current_date.year
+        month = current_date.month
+    return date(year, month, 1)
+
+
+def get_shared_backend() -> StorageBackend:
+    """Return the process-wide storage backend selected by the db-backend setting."""
+    global _shared_backend
+
+    if _shared_backend is None:
+        with _shared_lock:
+            if _shared_backend is None:
+                _shared_backend = create_backend()
+    return _shared_backend
+
+
+def get_shared_pool() -> ConnectionPool:
+    """Return the process-wide connection pool, creating it on first use."""
+    global _shared_pool
+
+    if _shared_pool is None:
+        backend = get_shared_backend()
+        with _shared_lock:
+            if _shared_pool is None:
+                _shared_pool = ConnectionPool(
+                    backend.connect,
+                    ping_query=backend.ping_query,
+                    max_size=int(os.environ.get("sql-pool-size", 10)),
+                    timeout=float(os.environ.get("sql-pool-timeout", 30)),
+                    max_idle=float(os.environ.get("sql-pool-max-idle", 300)),
+                    ping_interval=float(os.environ.get("sql-pool-ping-interval", 30)),
+                )
+    return _shared_pool
+
+
+def get_settings_cache() -> TTLCache:
+    """Return the process-wide cache for the global token limit and active user count.
+
+    If ``cache-invalidation-file`` is set, invalidations are broadcast to the other
+    worker processes through that file.
+    """
+    global _shared_settings_cache
+
+    if _shared_settings_cache is None:
+        with _shared_lock:
+            if _shared_settings_cache is None:
+                channel_path = os.environ.get("cache-invalidation-file")
+                _shared_settings_cache = TTLCache(
+                    ttl=float(os.environ.get("settings-cache-ttl", 60)),
+                    channel=(
+                        FileInvalidationChannel(channel_path) if channel_path else None
+                    ),
+                )
+    return _shared_settings_cache
+
+
+def get_profile_cache() -> TTLCache:
+    """Return the process-wide LRU cache of Student profiles keyed by student_id.
+
+    If ``cache-invalidation-file`` is set, invalidations are broadcast to the other
+    worker processes through a ``.profiles`` file next to it. A profile change in
+    one worker then clears the whole profile cache in the others.
+    """
+    global _shared_profile_cache
+
+    if _shared_profile_cache is None:
+        with _shared_lock:
+            if _shared_profile_cache is None:
+                channel_path = os.environ.get("cache-invalidation-file")
+                _shared_profile_cache = TTLCache(
+                    ttl=float(os.environ.get("profile-cache-ttl", 300)),
+                    maxsize=int(os.environ.get("profile-cache-size", 5000)),
+                    channel=(
+                        FileInvalidationChannel(f"{channel_path}.profiles")
+                        if channel_path
+                        else None
+                    ),
+                )
+    return _shared_profile_cache
+
+
+def get_usage_recorder(writer) -> UsageRecorder:
+    """Return the process-wide write-behind token usage recorder.
+
+    ``writer`` is only used when the recorder is created by this call.
+    """
+    global _shared_usage_recorder
+
+    if _shared_usage_recorder is None:
+        with _shared_lock:
+            if _shared_usage_recorder is None:
+                _shared_usage_recorder = UsageRecorder(
+                    writer,
+                    batch_size=int(os.environ.get("usage-flush-size", 100)),
+                    flush_interval=float(os.environ.get("usage-flush-interval", 1)),
+                )
+    return _shared_usage_recorder
+
+
+def get_query_metrics() -> QueryMetrics:
+    """Return the process-wide per-query metrics.
+
+    Queries slower than ``sql-slow-query-ms`` milliseconds are logged.
+    """
+    global _shared_query_metrics
+
+    if _shared_query_metrics is None:
+        with _shared_lock:
+            if _shared_query_metrics is None:
+                _shared_query_metrics = QueryMetrics(
+                    slow_query_ms=float(os.environ.get("sql-slow-query-ms", 500)),
+                )
+    return _shared_query_metrics
 
 
 class DatabaseClient:
-    def __init__(self):
-        """Initialize the database connection using Streamlit secrets."""
-        self.conn = self._init_connection()
-
-    def _init_connection(self):
-        """Initialize and return a database connection using credentials from st.secrets."""
-        connection_str = (
-            "DRIVER={ODBC Driver 17 for SQL Server};"
-            "SERVER=" + os.environ["sql-server"] + ";"
-            "DATABASE=" + os.environ["sql-db"] + ";"
-            "UID=" + os.environ["sql-user"] + ";"
-            "PWD=" + os.environ["sql-password"]
+    def __init__(
+        self,
+        backend: StorageBackend = None,
+        pool: ConnectionPool = None,
+        settings_cache: TTLCache = None,
+        usage_recorder: UsageRecorder = None,
+        profile_cache: TTLCache = None,
+        query_metrics: QueryMetrics = None,
+        password_hasher: PasswordHasher = None,
+    ):
+        """Use the shared backend, pool, caches and usage recorder unless specific ones
+        are given. A custom backend should come with a pool that connects through it."""
+        # Compared with None, since an empty cache is falsy
+        self.backend = get_shared_backend() if backend is None else backend
+        self.pool = get_shared_pool() if pool is None else pool
+        self.settings_cache = (
+            get_settings_cache() if settings_cache is None else settings_cache
+        )
+        self.profile_cache = (
+            get_profile_cache() if profile_cache is None else profile_cache
+        )
+        self.query_metrics = (
+            get_query_metrics() if query_metrics is None else query_metrics
         )
-        return pyodbc.connect(connection_str)
+        self.password_hasher = (
+            get_password_hasher() if password_hasher is None else password_hasher
+        )
+        self.usage_recorder = (
+            get_usage_recorder(self.write_token_usage)
+            if usage_recorder is None
+            else usage_recorder
+        )
+
+    @contextmanager
+    def _cursor(self):
+        """Check out a pooled connection and yield an instrumented cursor on it.
+
+        Its execute methods take a query name first, for example
+        ``cursor.execute("get_student_info", query, (student_id,))``.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield InstrumentedCursor(cursor, self.query_metrics)
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def _flush_usage(self):
+        """Write buffered token usage before a usage report.
+
+        A failed write is only logged: the records stay buffered for the background
+        flush, and the report shows what is already in the database.
+        """
+        try:
+            self.usage_recorder.flush()
+        except Exception as e:
+            print(f"Error flushing token usage before report: {e}")
+
+    def pool_stats(self) -> dict:
+        """Return connection pool size and wait metrics."""
+        return self.pool.stats()
+
+    def settings_cache_stats(self) -> dict:
+        """Return hit/miss counters of the global limit and active user cache."""
+        return self.settings_cache.stats()
+
+    def profile_cache_stats(self) -> dict:
+        """Return hit/miss counters of the student profile cache."""
+        return self.profile_cache.stats()
+
+    def usage_recorder_stats(self) -> dict:
+        """Return buffer size and flush counters of the token usage recorder."""
+        return self.usage_recorder.stats()
+
+    def query_stats(self) -> dict:
+        """Return latency histograms, row and error counts per query name."""
+        return self.query_metrics.stats()
+
+    def ensure_schema(self) -> list:
+        """Apply pending schema migrations once per process.
+
+        Returns the migration versions that were applied.
+        """
+        global _schema_ready
+
+        if _schema_ready:
+            return []
+
+        with self.pool.connection() as conn:
+            applied = schema.apply_migrations(conn, self.backend)
+
+        _schema_ready = True
+        return applied
 
     def get_student_info(self, student_id: int) -> Optional[Student]:
-        """Retrieve student information including courses, grades, and program."""
+        """Retrieve student information including courses, grades, and program.
+
+        Profiles are served from the profile cache when possible. Unknown students
+        are not cached, so a later registration is visible immediately.
+        """
+        cached = self.profile_cache.get(student_id)
+        if cached is not None:
+            return cached
+
         query = """
         SELECT s.id, s.name, s.email, c.name, g.grade, c.european_credits, c.id, g.created_at, g.feedback,
                p.id, p.name, p.european_credits
@@ -35,32 +261,74 @@ class DatabaseClient:
         WHERE s.id = ?;
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, (student_id,))
-            results = cursor.fetchall()
-
-        if not results:
+        student_row = None
+        courses = []
+
+        # Build the records in one pass; the student and program columns repeat per row
+        with self._cursor() as cursor:
+            cursor.execute("get_student_info", query, (student_id,))
+            for row in cursor:
+                if student_row is None:
+                    student_row = row
+                if row[6] is not None:
+                    courses.append(
+                        Course(row[6], row[3], row[4], row[5], row[7], row[8])
+                    )
+
+        if student_row is None:
             return None
 
-        student_id, name, email = results[0][:3]
-        courses = [
-            {
-                "course_name": row[3],
-                "grade": row[4],
-                "ec": row[5],
-                "id": row[6],
-                "created_at": row[7],
-                "feedback": row[8],
-            }
-            for row in results
-        ]
-        program = {
-            "program_id": results[0][9],
-            "program_name": results[0][10],
-            "program_ec": results[0][11],
-        }
+        student_id, name, email = student_row[:3]
+        program = (
+            Program(student_row[9], student_row[10], student_row[11])
+            if student_row[9] is not None
+            else None
+        )
+
+        student = Student(student_id, name, email, tuple(courses), program)
+        self.profile_cache.set(student_id, student)
+        return student
+
+    def get_or_create_student(
+        self, name: str, email: str, password_hash: str = None
+    ) -> Tuple[int, bool]:
+        """Return the id of the student with ``email``, adding the student if needed.
+
+        The lookup and the insert are a single atomic statement. Returns
+        ``(student_id, created)``; name and password are only used for new students.
+        """
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "get_or_create_student",
+                    self.backend.get_or_create_student,
+                    (name, email, password_hash),
+                )
+                result = cursor.fetchone()
+                cursor.connection.commit()
+        except Exception as e:
+            if not self.backend.is_integrity_error(e):
+                print(f"Error adding new student: {e}")
+                raise
+
+            # Lost a race on the unique email; the other insert won
+            student_id = self.get_student_id_by_email(email)
+            if student_id is None:
+                print(f"Error adding new student: {e}")
+                raise
+            return student_id, False
+
+        if result is None:
+            # The backend reports existing students without returning their id
+            return self.get_student_id_by_email(email), False
 
-        return Student(student_id, name, email, courses, program)
+        student_id, created = result[0], bool(result[1])
+        if created:
+            # The per-user limit depends on the number of registered students;
+            # unknown students are not in the profile cache
+            self.settings_cache.invalidate("active_users")
+
+        return student_id, created
 
     def add_new_student(
         self, name: str, email: str, password_hash: str = None
@@ -69,27 +337,12 @@ class DatabaseClient:
         Add a new student to the database. Password hash is optional for SSO users.
         """
         try:
-            # Check if a student with this email already exists
-            if self.email_already_exist(email):
+            student_id, created = self.get_or_create_student(name, email, password_hash)
+            if not created:
                 raise ValueError(f"Student with email {email} already exists")
 
-            # Insert into Student table with possibly null password for SSO users
-            query = """
-            INSERT INTO dbo.Student (name, email, password)
-            VALUES (?, ?, ?);
-            """
-
-            with self.conn.cursor() as cursor:
-                cursor.execute(query, (name, email, password_hash))
-                student_id = cursor.execute("SELECT SCOPE_IDENTITY();").fetchval()
-                cursor.commit()
-
-                # Create empty initial data
-                empty_courses = []
-                empty_program = {}
-
-                # Create and return a new Student object
-                return Student(student_id, name, email, empty_courses, empty_program)
+            # Create and return a new Student object without courses or program
+            return Student(student_id, name, email, (), None)
 
         except Exception as e:
             print(f"Error adding new student: {e}")
@@ -108,8 +361,8 @@ class DatabaseClient:
             WHERE s.id = ?
         );
         """
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, (student_id,))
+        with self._cursor() as cursor:
+            cursor.execute("demo_courses", query, (student_id,))
             course_ids = [row[0] for row in cursor.fetchall()]
 
         # Randomly select a subset of courses, and generate random grades
@@ -121,9 +374,44 @@ class DatabaseClient:
         INSERT INTO dbo.Grade (student_id, course_id, grade)
         VALUES (?, ?, ?);
         """
-        with self.conn.cursor() as cursor:
-            cursor.executemany(query, grades)
-            cursor.commit()
+        with self._cursor() as cursor:
+            self.backend.prepare_bulk_cursor(cursor)
+            cursor.executemany("insert_demo_grades", query, grades)
+            cursor.connection.commit()
+
+        self.profile_cache.invalidate(student_id)
+
+    def bulk_load(self, kind: str, rows: list) -> int:
+        """Insert one batch of programs, courses, students or grades.
+
+        ``rows`` are tuples in the column order of the backend's staging table for
+        ``kind``. They are sent with array binding to a staging table, and a single
+        statement resolves program, course and student names to ids and inserts
+        the rows that do not exist yet. Returns the number of rows inserted.
+        """
+        create_stage, insert_stage, resolve = self.backend.bulk_load[kind]
+
+        with self._cursor() as cursor:
+            self.backend.run_script(cursor, create_stage, f"bulk_create_stage_{kind}")
+            self.backend.prepare_bulk_cursor(cursor)
+            cursor.executemany(f"bulk_stage_{kind}", insert_stage, rows)
+            cursor.execute(f"bulk_resolve_{kind}", resolve)
+            inserted = max(cursor.rowcount, 0)
+            cursor.connection.commit()
+
+        # Reloading a file that is already in the database inserts nothing
+        if not inserted:
+            return inserted
+
+        if kind == "students":
+            self.settings_cache.invalidate("active_users")
+        elif kind == "grades":
+            # Grades are matched to students by email in SQL, so the ids of the
+            # affected students are not known here; one clear per batch is also
+            # a single broadcast instead of one per student
+            self.profile_cache.invalidate()
+
+        return inserted
 
     def check_user_login(self, email: str, password: str):
         query = """
@@ -132,12 +420,22 @@ class DatabaseClient:
         WHERE email = ?;
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, (email,))
+        with self._cursor() as cursor:
+            cursor.execute("check_user_login", query, (email,))
             result = cursor.fetchone()
 
-            if check_password_hash(result[1], password):
-                return result[2]
+        # Unknown users and SSO users without a password cannot log in this way
+        if not result or not result[1]:
+            return None
+
+        if not self.password_hasher.verify(result[1], password):
+            return None
+
+        # Upgrade hashes made with an older method or cost while the password is known
+        if self.password_hasher.needs_rehash(result[1]):
+            self.update_student_password(email, self.password_hasher.hash(password))
+
+        return result[2]
 
     def email_already_exist(self, email: str):
         query = """
@@ -146,8 +444,8 @@ class DatabaseClient:
         WHERE email = ?;
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, (email,))
+        with self._cursor() as cursor:
+            cursor.execute("email_already_exist", query, (email,))
             result = cursor.fetchone()
 
         if not result:
@@ -155,168 +453,261 @@ class DatabaseClient:
 
         return True
 
-    def get_monthly_token_usage(self, year=None, month=None):
+    def get_monthly_token_usage(
+        self, year=None, month=None, after_student_id=None, limit=None
+    ):
         """Get token usage per user for a specific month
         If year and month are not provided, returns current month's data
         """
-        if year is None or month is None:
-            current_date = datetime.now()
-            year = current_date.year
-            month = current_date.month
+        return list(self.iter_monthly_token_usage(year, month, after_student_id, limit))
 
-        query = """
-        SELECT s.id, s.email, s.name, COALESCE(SUM(tu.tokens), 0) AS total_tokens_used
-        FROM dbo.student s
-        INNER JOIN Tokenusage tu
-            ON s.id = tu.student_id
-            AND YEAR(tu.date_time) = ?
-            AND MONTH(tu.date_time) = ?
-        GROUP BY s.id, s.email, s.name
-        ORDER BY s.id;
+    def iter_monthly_token_usage(
+        self, year=None, month=None, after_student_id=None, limit=None, batch_size=500
+    ):
+        """Yield per-user token usage for a month, ordered by student id.
+
+        Uses keyset pagination: only students with an id greater than
+        ``after_student_id`` are returned, at most ``limit`` of them. Rows are
+        fetched from the server cursor ``batch_size`` at a time, so memory use
+        does not grow with the number of students.
         """
+        self._flush_usage()
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, (year, month))
-            results = cursor.fetchall()
+        params = (
+            _month_start(year, month),
+            after_student_id if after_student_id is not None else 0,
+            limit if limit is not None else 2147483647,
+        )
 
-        return [
-            {
-                "student_id": row[0],
-                "email": row[1],
-                "name": row[2],
-                "tokens_used": row[3],
-            }
-            for row in results
-        ]
+        with self._cursor() as cursor:
+            cursor.execute(
+                "monthly_usage_page", self.backend.monthly_usage_page, params
+            )
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield {
+                        "student_id": row[0],
+                        "email": row[1],
+                        "name": row[2],
+                        "tokens_used": row[3],
+                    }
 
     def get_user_token_usage(self):
         """Get token usage for all users in the last 24 hours"""
+        self._flush_usage()
+
         query = """
         SELECT s.email, SUM(tu.tokens) AS total_tokens_used
         FROM dbo.student s
         INNER JOIN Tokenusage tu
             ON s.id = tu.student_id
-        WHERE tu.date_time >= DATEADD(HOUR, -24, GETDATE())
+        WHERE tu.date_time >= ?
         GROUP BY s.email;
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query)
+        with self._cursor() as cursor:
+            cursor.execute(
+                "user_token_usage_24h", query, (datetime.now() - timedelta(hours=24),)
+            )
             results = cursor.fetchall()
 
         # Return results in a dictionary format
         return {row[0]: row[1] for row in results}
 
     def add_token_usage(self, student_id: int, tokens: int):
-        query = """
-        INSERT INTO Tokenusage (student_id, tokens)
-        VALUES (?, ?);
+        """Queue token usage; it is written in the background by write_token_usage"""
+        self.usage_recorder.record(student_id, tokens)
+
+    def reserve_tokens(self, student_id: int, tokens: int) -> Optional[int]:
+        """Hold ``tokens`` of a user's monthly quota for an in-flight request.
+
+        The quota check and the hold happen in one statement, so concurrent
+        requests from the same student cannot overspend. Returns the reservation
+        id, or None if the tokens would exceed the user's limit. Settle the
+        reservation with commit_token_reservation or release_token_reservation;
+        unsettled reservations expire after ``reservation-ttl`` seconds.
+        """
+        now = datetime.now()
+        month_start = _month_start(now.year, now.month)
+        expires_at = now + timedelta(
+            seconds=float(os.environ.get("reservation-ttl", 300))
+        )
+
+        # Buffered usage that is not held by a reservation is not in the database yet
+        unreserved = self.usage_recorder.pending_tokens(
+            student_id, month_start, include_reserved=False
+        )
+
+        # Before checking out a connection, since a cache miss needs one of its own
+        user_limit = self.get_user_token_limit(student_id)
+
+        with self._cursor() as cursor:
+            cursor.execute(
+                "reserve_tokens",
+                self.backend.reserve_tokens,
+                (
+                    student_id,
+                    tokens,
+                    expires_at,
+                    student_id,
+                    month_start,
+                    student_id,
+                    now,
+                    tokens + unreserved,
+                    user_limit,
+                ),
+            )
+            result = cursor.fetchone()
+            cursor.connection.commit()
+
+        return result[0] if result else None
+
+    def commit_token_reservation(
+        self, reservation_id: int, student_id: int, tokens: int
+    ):
+        """Replace a reservation with the tokens the request actually used.
+
+        The usage is queued like add_token_usage; the reservation is deleted in
+        the same transaction that writes it.
+        """
+        self.usage_recorder.record(student_id, tokens, reservation_id)
+
+    def release_token_reservation(self, reservation_id: int):
+        """Give back a reservation without recording any usage."""
+        with self._cursor() as cursor:
+            cursor.execute(
+                "release_token_reservation",
+                "DELETE FROM TokenReservation WHERE id = ?;",
+                (reservation_id,),
+            )
+            cursor.connection.commit()
+
+    def write_token_usage(self, records: list):
+        """Insert a batch of (student_id, tokens, recorded_at, reservation_id) usage
+        records, add them to the students' monthly rollups and delete the
+        reservations they settle in a single transaction."""
+
+        insert_query = """
+        INSERT INTO Tokenusage (student_id, tokens, date_time)
+        VALUES (?, ?, ?);
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, (student_id, tokens))
-            cursor.commit()
+        # One rollup update per student and month, however many records it has
+        rollup = defaultdict(int)
+        reservations = []
+        for student_id, tokens, recorded_at, reservation_id in records:
+            rollup[(student_id, _month_start(recorded_at.year, recorded_at.month))] += (
+                tokens
+            )
+            if reservation_id is not None:
+                reservations.append((reservation_id,))
+
+        with self._cursor() as cursor:
+            self.backend.prepare_bulk_cursor(cursor)
+            cursor.executemany(
+                "insert_token_usage",
+                insert_query,
+                [
+                    (student_id, tokens, recorded_at)
+                    for student_id, tokens, recorded_at, _ in records
+                ],
+            )
+            cursor.executemany(
+                "upsert_usage_rollup",
+                self.backend.upsert_usage_rollup,
+                [
+                    (student_id, month_start, tokens)
+                    for (student_id, month_start), tokens in rollup.items()
+                ],
+            )
+            if reservations:
+                cursor.executemany(
+                    "settle_token_reservations",
+                    "DELETE FROM TokenReservation WHERE id = ?;",
+                    reservations,
+                )
+            # Reservations of requests that never settled them
+            cursor.execute(
+                "expire_token_reservations",
+                "DELETE FROM TokenReservation WHERE expires_at <= ?;",
+                (datetime.now(),),
+            )
+            cursor.connection.commit()
 
     def get_active_users_count(self):
         """Get count of active users in the system (all registered students)"""
+        cached = self.settings_cache.get("active_users")
+        if cached is not None:
+            return cached
+
         query = """
         SELECT COUNT(id) FROM dbo.Student;
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query)
+        with self._cursor() as cursor:
+            cursor.execute("active_users_count", query)
             result = cursor.fetchone()
 
-        return result[0] if result else 0
+        active_users = result[0] if result else 0
+        self.settings_cache.set("active_users", active_users)
+        return active_users
 
     def set_global_token_limit(self, monthly_limit: int):
         """Set global token limit for all users"""
-        # First check if we have a token_settings table
-        check_query = """
-        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenSettings')
-        BEGIN
-            CREATE TABLE TokenSettings (
-                id INT PRIMARY KEY IDENTITY(1,1),
-                setting_name VARCHAR(100) NOT NULL,
-                setting_value INT NOT NULL,
-                updated_at DATETIME DEFAULT GETDATE()
-            );
-        END
-        """
+        # Update or insert the global limit
+        with self._cursor() as cursor:
+            cursor.execute(
+                "set_global_token_limit",
+                self.backend.upsert_global_limit,
+                (monthly_limit,),
+            )
+            cursor.connection.commit()
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(check_query)
-            cursor.commit()
-
-        # Now update or insert the global limit
-        upsert_query = """
-        MERGE INTO TokenSettings AS target
-        USING (SELECT 'monthly_global_limit' AS setting_name, ? AS setting_value) AS source
-        ON target.setting_name = source.setting_name
-        WHEN MATCHED THEN
-            UPDATE SET target.setting_value = source.setting_value, target.updated_at = GETDATE()
-        WHEN NOT MATCHED THEN
-            INSERT (setting_name, setting_value)
-            VALUES (source.setting_name, source.setting_value);
-        """
-
-        with self.conn.cursor() as cursor:
-            cursor.execute(upsert_query, (monthly_limit,))
-            cursor.commit()
+        self.settings_cache.invalidate("global_limit")
 
         return True
 
     def get_global_token_limit(self):
         """Get the current global monthly token limit"""
-        # First check if we have a token_settings table
-        check_query = """
-        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenSettings')
-        BEGIN
-            CREATE TABLE TokenSettings (
-                id INT PRIMARY KEY IDENTITY(1,1),
-                setting_name VARCHAR(100) NOT NULL,
-                setting_value INT NOT NULL,
-                updated_at DATETIME DEFAULT GETDATE()
-            );
-
-            INSERT INTO TokenSettings (setting_name, setting_value)
-            VALUES ('monthly_global_limit', 1000000);
-        END
-        """
-
-        with self.conn.cursor() as cursor:
-            cursor.execute(check_query)
-            cursor.commit()
+        cached = self.settings_cache.get("global_limit")
+        if cached is not None:
+            return cached
 
         query = """
         SELECT setting_value FROM TokenSettings
         WHERE setting_name = 'monthly_global_limit';
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query)
+        with self._cursor() as cursor:
+            cursor.execute("global_token_limit", query)
             result = cursor.fetchone()
 
-        return result[0] if result else 1000000  # Default to 1 million tokens
+        global_limit = result[0] if result else 1000000  # Default to 1 million tokens
+        self.settings_cache.set("global_limit", global_limit)
+        return global_limit
 
     def get_user_monthly_usage(self, student_id: int, year=None, month=None):
         """Get token usage for a specific user in the current month"""
-        if year is None or month is None:
-            current_date = datetime.now()
-            year = current_date.year
-            month = current_date.month
 
         query = """
-        SELECT COALESCE(SUM(tokens), 0) AS monthly_usage
-        FROM Tokenusage
-        WHERE student_id = ? AND YEAR(date_time) = ? AND MONTH(date_time) = ?;
+        SELECT tokens
+        FROM TokenUsageMonthly
+        WHERE student_id = ? AND month_start = ?;
         """
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, (student_id, year, month))
+        month_start = _month_start(year, month)
+
+        with self._cursor() as cursor:
+            cursor.execute("user_monthly_usage", query, (student_id, month_start))
             result = cursor.fetchone()
 
-        return result[0] if result and result[0] is not None else 0
+        usage = result[0] if result and result[0] is not None else 0
+
+        # Include usage that is still waiting in the write-behind buffer
+        return usage + self.usage_recorder.pending_tokens(student_id, month_start)
 
     def get_user_token_limit(self, student_id: int):
         """Calculate a user's token limit based on the global limit and active user count"""
@@ -331,19 +722,100 @@ class DatabaseClient:
 
         return per_user_limit
 
-    def can_user_use_tokens(self, student_id: int, required_tokens: int):
-        """Check if a user can use the specified number of tokens"""
-        # Get user's monthly limit
-        user_limit = self.get_user_token_limit(student_id)
+    def get_quota_snapshot(self, student_id: int, year=None, month=None) -> dict:
+        """Get a user's token quota in a single round trip.
+
+        Returns the global limit, active user count, the user's per-user limit,
+        their usage for the month and the remaining budget. Like reserve_tokens,
+        the usage includes the tokens held by unexpired reservations, which are
+        also reported on their own as ``reserved``.
+        """
+        now = datetime.now()
+        month_start = _month_start(year, month)
+
+        usage_query = """
+        SELECT
+            (
+                SELECT COALESCE(SUM(tokens), 0)
+                FROM TokenUsageMonthly
+                WHERE student_id = ? AND month_start = ?
+            ),
+            (
+                SELECT COALESCE(SUM(tokens), 0)
+                FROM TokenReservation
+                WHERE student_id = ? AND expires_at > ?
+            );
+        """
+
+        global_limit = self.settings_cache.get("global_limit")
+        active_users = self.settings_cache.get("active_users")
+
+        if global_limit is not None and active_users is not None:
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "quota_usage",
+                    usage_query,
+                    (student_id, month_start, student_id, now),
+                )
+                usage, reserved = cursor.fetchone()
+        else:
+            query = """
+            SELECT
+                COALESCE(
+                    (
+                        SELECT setting_value FROM TokenSettings
+                        WHERE setting_name = 'monthly_global_limit'
+                    ),
+                    1000000
+                ),
+                (SELECT COUNT(id) FROM dbo.Student),
+                (
+                    SELECT COALESCE(SUM(tokens), 0)
+                    FROM TokenUsageMonthly
+                    WHERE student_id = ? AND month_start = ?
+                ),
+                (
+                    SELECT COALESCE(SUM(tokens), 0)
+                    FROM TokenReservation
+                    WHERE student_id = ? AND expires_at > ?
+                );
+            """
+
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "quota_snapshot",
+                    query,
+                    (student_id, month_start, student_id, now),
+                )
+                global_limit, active_users, usage, reserved = cursor.fetchone()
+
+            self.settings_cache.set("global_limit", global_limit)
+            self.settings_cache.set("active_users", active_users)
 
-        # Get user's current usage this month
-        current_usage = self.get_user_monthly_usage(student_id)
+        # Include usage that is still waiting in the write-behind buffer; buffered
+        # usage that settles a reservation is still counted by that reservation
+        usage += reserved + self.usage_recorder.pending_tokens(
+            student_id, month_start, include_reserved=False
+        )
+
+        # Equal distribution among users, preventing division by zero
+        user_limit = global_limit // max(active_users, 1)
 
-        # Calculate what the total would be after this request
-        total_after_request = current_usage + required_tokens
+        return {
+            "global_limit": global_limit,
+            "active_users": active_users,
+            "limit": user_limit,
+            "usage": usage,
+            "reserved": reserved,
+            "remaining": max(user_limit - usage, 0),
+        }
+
+    def can_user_use_tokens(self, student_id: int, required_tokens: int):
+        """Check if a user can use the specified number of tokens"""
+        quota = self.get_quota_snapshot(student_id)
 
         # Allow the request if the user hasn't exceeded their limit
-        return total_after_request <= user_limit
+        return quota["usage"] + required_tokens <= quota["limit"]
 
     def update_student_email(self, current_email: str, new_email: str) -> bool:
         """Update a student's email address
@@ -356,17 +828,19 @@ class DatabaseClient:
             bool: True if successful, False otherwise
         """
         try:
-            query = """
-            UPDATE dbo.Student
-            SET email = ?
-            WHERE email = ?;
-            """
-            with self.conn.cursor() as cursor:
-                cursor.execute(query, (new_email, current_email))
-                affected_rows = cursor.rowcount
-                cursor.commit()
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "update_student_email",
+                    self.backend.update_student_email,
+                    (new_email, current_email),
+                )
+                updated_ids = [row[0] for row in cursor.fetchall()]
+                cursor.connection.commit()
 
-            return affected_rows > 0
+            for student_id in updated_ids:
+                self.profile_cache.invalidate(student_id)
+
+            return len(updated_ids) > 0
         except Exception as e:
             print(f"Error updating email: {e}")
             return False
@@ -387,10 +861,12 @@ class DatabaseClient:
             SET password = ?
             WHERE email = ?;
             """
-            with self.conn.cursor() as cursor:
-                cursor.execute(query, (hashed_password, email))
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "update_student_password", query, (hashed_password, email)
+                )
                 affected_rows = cursor.rowcount
-                cursor.commit()
+                cursor.connection.commit()
 
             return affected_rows > 0
         except Exception as e:
@@ -404,8 +880,8 @@ class DatabaseClient:
         try:
             # Get student ID from Student table
             query = "SELECT id FROM dbo.Student WHERE email = ?;"
-            with self.conn.cursor() as cursor:
-                cursor.execute(query, (email,))
+            with self._cursor() as cursor:
+                cursor.execute("student_id_by_email", query, (email,))
                 result = cursor.fetchone()
                 return result[0] if result else None
         except Exception as e:
@@ -415,33 +891,11 @@ class DatabaseClient:
     def get_cached_token_usage(self, student_id: int):
         """Get cached token usage data for an SSO user"""
         try:
-            # Check if we have a token_usage_cache table
-            check_query = """
-            IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenUsageCache')
-            BEGIN
-                CREATE TABLE TokenUsageCache (
-                    student_id INT NOT NULL,
-                    usage INT NOT NULL,
-                    limit_value INT NOT NULL,
-                    percentage_used FLOAT NOT NULL,
-                    last_updated DATETIME DEFAULT GETDATE(),
-                    PRIMARY KEY (student_id)
-                );
-            END
-            """
-            with self.conn.cursor() as cursor:
-                cursor.execute(check_query)
-                cursor.commit()
-
             # Get cached data if it exists and is less than 5 minutes old
-            query = """
-            SELECT usage, limit_value, percentage_used
-            FROM TokenUsageCache
-            WHERE student_id = ?
-            AND last_updated >= DATEADD(MINUTE, -5, GETDATE());
-            """
-            with self.conn.cursor() as cursor:
-                cursor.execute(query, (student_id,))
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "select_usage_cache", self.backend.select_usage_cache, (student_id,)
+                )
                 result = cursor.fetchone()
 
                 if result:
@@ -459,45 +913,11 @@ class DatabaseClient:
     def cache_token_usage(self, student_id: int, usage_data: dict):
         """Cache token usage data for an SSO user"""
         try:
-            # First ensure the table exists
-            check_query = """
-            IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenUsageCache')
-            BEGIN
-                CREATE TABLE TokenUsageCache (
-                    student_id INT NOT NULL,
-                    usage INT NOT NULL,
-                    limit_value INT NOT NULL,
-                    percentage_used FLOAT NOT NULL,
-                    last_updated DATETIME DEFAULT GETDATE(),
-                    PRIMARY KEY (student_id)
-                );
-            END
-            """
-
-            # Then upsert the data
-            upsert_query = """
-            MERGE TokenUsageCache AS target
-            USING (SELECT ? as student_id, ? as usage, ? as limit_value, ? as percentage_used) AS source
-            ON (target.student_id = source.student_id)
-            WHEN MATCHED THEN
-                UPDATE SET
-                    usage = source.usage,
-                    limit_value = source.limit_value,
-                    percentage_used = source.percentage_used,
-                    last_updated = GETDATE()
-            WHEN NOT MATCHED THEN
-                INSERT (student_id, usage, limit_value, percentage_used)
-                VALUES (source.student_id, source.usage, source.limit_value, source.percentage_used);
-            """
-
-            with self.conn.cursor() as cursor:
-                # Ensure table exists
-                cursor.execute(check_query)
-                cursor.commit()
-
-                # Insert/update the data
+            # Upsert the data
+            with self._cursor() as cursor:
                 cursor.execute(
-                    upsert_query,
+                    "upsert_usage_cache",
+                    self.backend.upsert_usage_cache,
                     (
                         student_id,
                         usage_data["usage"],
@@ -505,7 +925,7 @@ class DatabaseClient:
                         usage_data["percentage_used"],
                     ),
                 )
-                cursor.commit()
+                cursor.connection.commit()
 
             return True
         except Exception as e:
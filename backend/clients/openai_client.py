@@ -3,21 +3,22 @@ OpenAI Client that interacts with the Azure OpenAI API.
 """
 
 import os
-from dotenv import load_dotenv
 from openai import AzureOpenAI
 
 
 class OpenAIClient:
     """Client for interacting with the Azure OpenAI API to generate responses using GPT models."""
 
-    def __init__(self):
-        load_dotenv()
+    def __init__(self, http_client=None):
+        """``http_client`` is an optional httpx.Client, to share its connection pool."""
         self.client = AzureOpenAI(
             azure_endpoint=os.environ["azure-openai-endpoint"],
             api_key=os.environ["azure-openai-api-key"],
             api_version="2024-08-01-preview",
+            http_client=http_client,
         )
         self.model = os.environ["azure-openai-gpt-model-deployment-id"]
+        self.embedding_model = os.environ.get("azure-openai-embedding-deployment-id")
 
     def generate_response(
         self, messages, temperature=0.7, max_tokens=800, top_p=0.9, **kwargs
@@ -34,6 +35,35 @@ class OpenAIClient:
         )
         return response.choices[0].message.content
 
+    def stream_response(
+        self, messages, temperature=0.7, max_tokens=800, top_p=0.9, **kwargs
+    ):
+        """Generates a response like generate_response, yielding content deltas as they arrive."""
+
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            stream=True,
+            **kwargs
+        )
+        try:
+            for chunk in stream:
+                # Azure sends content filter results in chunks without choices
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Stop the generation when the consumer goes away early
+            stream.close()
+
+    def embed(self, text):
+        """Returns the embedding vector of the text, using the embedding deployment."""
+
+        response = self.client.embeddings.create(model=self.embedding_model, input=text)
+        return response.data[0].embedding
+
     def empty_method(self):
         """Placeholder method for future functionality."""
         print("OpenAIClient is active and ready.")
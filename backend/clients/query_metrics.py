@@ -0,0 +1,187 @@
+"""
+Per-query latency, row and error metrics for DatabaseClient, with a slow-query log.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in milliseconds of the latency histogram buckets; slower queries
+# fall into a final overflow bucket
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _describe_params(params) -> str:
+    """Describe query parameters by their types, without their values."""
+    if isinstance(params, (list, tuple)):
+        types = ", ".join(type(param).__name__ for param in params)
+        return f"<{len(params)} parameters: {types}>"
+    if isinstance(params, str):
+        # Already a description, e.g. the size of an executemany batch
+        return params
+    return f"<{type(params).__name__}>"
+
+
+class QueryMetrics:
+    """Thread-safe counters and latency histograms keyed by query name.
+
+    Queries that take at least ``slow_query_ms`` milliseconds are logged with
+    their statement and the types of their parameters; parameter values can hold
+    password hashes and personal data, so they are never logged. A threshold of
+    0 or less disables the log.
+    """
+
+    def __init__(self, slow_query_ms: float = 500):
+        self.slow_query_ms = slow_query_ms
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, name: str) -> dict:
+        entry = self._queries.get(name)
+        if entry is None:
+            entry = self._queries[name] = {
+                "calls": 0,
+                "errors": 0,
+                "rows": 0,
+                "slow": 0,
+                "time_total": 0.0,
+                "time_max": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+        return entry
+
+    def observe(
+        self, name: str, elapsed: float, sql: str, params=None, error: bool = False
+    ):
+        """Record one execution of ``name`` that took ``elapsed`` seconds.
+
+        ``params`` is only described in the slow-query log, by the types of its
+        items; a string is logged as the description itself.
+        """
+        elapsed_ms = elapsed * 1000
+        slow = 0 < self.slow_query_ms <= elapsed_ms
+
+        with self._lock:
+            entry = self._entry(name)
+            entry["calls"] += 1
+            entry["errors"] += error
+            entry["slow"] += slow
+            entry["time_total"] += elapsed
+            entry["time_max"] = max(entry["time_max"], elapsed)
+            entry["buckets"][bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+        if slow:
+            logging.warning(
+                f"Slow query {name} took {elapsed_ms:.1f} ms: "
+                f"{' '.join(sql.split())} params={_describe_params(params)}"
+            )
+
+    def add_rows(self, name: str, rows: int):
+        """Count rows returned or affected by ``name``."""
+        with self._lock:
+            self._entry(name)["rows"] += rows
+
+    def reset(self):
+        """Forget all recorded queries."""
+        with self._lock:
+            self._queries.clear()
+
+    def stats(self) -> dict:
+        """Return the metrics of every query name seen so far."""
+        bucket_labels = [f"le_{bound}ms" for bound in LATENCY_BUCKETS_MS] + ["inf"]
+
+        with self._lock:
+            return {
+                name: {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "rows": entry["rows"],
+                    "slow": entry["slow"],
+                    "time_total": round(entry["time_total"], 6),
+                    "time_avg": round(entry["time_total"] / entry["calls"], 6)
+                    if entry["calls"]
+                    else 0.0,
+                    "time_max": round(entry["time_max"], 6),
+                    "histogram": {
+                        label: entry["buckets"][i]
+                        for i, label in enumerate(bucket_labels)
+                    },
+                }
+                for name, entry in self._queries.items()
+            }
+
+
+class InstrumentedCursor:
+    """DB-API cursor wrapper whose execute methods take a query name first.
+
+    Execution time is recorded per name. Rows are counted as they are fetched
+    for queries that return a result set, and from ``rowcount`` otherwise. Any
+    other attribute is read from and written to the wrapped cursor.
+    """
+
+    def __init__(self, cursor, metrics: QueryMetrics):
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "_metrics", metrics)
+        object.__setattr__(self, "_name", None)
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._cursor, attr, value)
+
+    def _run(self, name: str, method, args: tuple, logged_params):
+        sql = args[0]
+        object.__setattr__(self, "_name", name)
+        start = time.perf_counter()
+        try:
+            method(*args)
+        except Exception:
+            self._metrics.observe(
+                name, time.perf_counter() - start, sql, logged_params, error=True
+            )
+            raise
+        self._metrics.observe(name, time.perf_counter() - start, sql, logged_params)
+
+        if self._cursor.description is None and self._cursor.rowcount > 0:
+            self._metrics.add_rows(name, self._cursor.rowcount)
+        return self
+
+    def execute(self, name: str, sql: str, params=()):
+        """Execute ``sql`` and record it under ``name``."""
+        args = (sql, params) if params else (sql,)
+        return self._run(name, self._cursor.execute, args, params)
+
+    def executemany(self, name: str, sql: str, seq_of_params):
+        """Execute ``sql`` for every parameter tuple and record it under ``name``."""
+        seq_of_params = list(seq_of_params)
+        # Log the batch size rather than every parameter tuple
+        logged_params = f"<{len(seq_of_params)} parameter sets>"
+        return self._run(
+            name, self._cursor.executemany, (sql, seq_of_params), logged_params
+        )
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._metrics.add_rows(self._name, 1)
+        return row
+
+    def fetchmany(self, size: int = None):
+        if size is None:
+            rows = self._cursor.fetchmany()
+        else:
+            rows = self._cursor.fetchmany(size)
+        self._metrics.add_rows(self._name, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._metrics.add_rows(self._name, len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._metrics.add_rows(self._name, 1)
+            yield row
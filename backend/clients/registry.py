@@ -0,0 +1,89 @@
+"""
+Process-wide Azure OpenAI and Azure Search clients with keep-alive connection pools.
+
+The clients are thread-safe and created on first use, after the app has loaded its
+settings, then shared by every request. Their connections are closed at exit.
+"""
+
+import atexit
+import os
+import threading
+
+import httpx
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from openai import DefaultHttpxClient
+from requests.adapters import HTTPAdapter
+
+from clients.openai_client import OpenAIClient
+from clients.search_client import AzureSearchClient
+
+_openai_client = None
+_openai_http_client = None
+_search_client = None
+_search_session = None
+_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAIClient:
+    """Return the shared Azure OpenAI client, sized by the openai-* settings."""
+    global _openai_client, _openai_http_client
+
+    if _openai_client is None:
+        with _lock:
+            if _openai_client is None:
+                max_connections = int(os.environ.get("openai-max-connections", 20))
+                _openai_http_client = DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=max_connections,
+                        max_keepalive_connections=max_connections,
+                        keepalive_expiry=float(
+                            os.environ.get("openai-keepalive-expiry", 60)
+                        ),
+                    )
+                )
+                _openai_client = OpenAIClient(http_client=_openai_http_client)
+    return _openai_client
+
+
+def get_search_client() -> AzureSearchClient:
+    """Return the shared Azure Search client, sized by the search-* settings."""
+    global _search_client, _search_session
+
+    if _search_client is None:
+        with _lock:
+            if _search_client is None:
+                max_connections = int(os.environ.get("search-max-connections", 20))
+                _search_session = requests.Session()
+                _search_session.mount(
+                    "https://",
+                    HTTPAdapter(pool_connections=1, pool_maxsize=max_connections),
+                )
+                _search_client = AzureSearchClient(
+                    transport=RequestsTransport(
+                        session=_search_session, session_owner=False
+                    )
+                )
+    return _search_client
+
+
+def search_cache_stats():
+    """Return the result cache stats of the shared Search client, if it was created."""
+    search_client = _search_client
+    return search_client.cache_stats() if search_client is not None else None
+
+
+def close_clients():
+    """Close the shared clients' connection pools; they are recreated on next use."""
+    global _openai_client, _openai_http_client, _search_client, _search_session
+
+    with _lock:
+        if _openai_http_client is not None:
+            _openai_http_client.close()
+        if _search_session is not None:
+            _search_session.close()
+        _openai_client = _openai_http_client = None
+        _search_client = _search_session = None
+
+
+atexit.register(close_clients)
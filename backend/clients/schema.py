@@ -0,0 +1,286 @@
+"""
+Versioned schema bootstrap for the tables the backend creates itself.
+
+Run once at startup through DatabaseClient.ensure_schema, or from the command line:
+
+    python -m clients.schema
+"""
+
+import logging
+
+# Ordered (version, description, batch) migrations per storage backend. Version
+# numbers are tracked separately by each backend.
+
+# Every SQL Server batch is idempotent so it can be applied to databases where the
+# tables were created by older versions of the app that ran DDL on every call. The
+# Student, Program, Course, Grade and Tokenusage tables are managed outside the app.
+SQLSERVER_MIGRATIONS = [
+    (
+        1,
+        "Token settings with the default monthly global limit",
+        """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenSettings')
+        BEGIN
+            CREATE TABLE TokenSettings (
+                id INT PRIMARY KEY IDENTITY(1,1),
+                setting_name VARCHAR(100) NOT NULL,
+                setting_value INT NOT NULL,
+                updated_at DATETIME DEFAULT GETDATE()
+            );
+
+            INSERT INTO TokenSettings (setting_name, setting_value)
+            VALUES ('monthly_global_limit', 1000000);
+        END
+        """,
+    ),
+    (
+        2,
+        "Token usage cache for SSO users",
+        """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenUsageCache')
+        BEGIN
+            CREATE TABLE TokenUsageCache (
+                student_id INT NOT NULL,
+                usage INT NOT NULL,
+                limit_value INT NOT NULL,
+                percentage_used FLOAT NOT NULL,
+                last_updated DATETIME DEFAULT GETDATE(),
+                PRIMARY KEY (student_id)
+            );
+        END
+        """,
+    ),
+    (
+        3,
+        "Monthly token usage rollup and Tokenusage indexes",
+        """
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Tokenusage_student_date')
+            CREATE INDEX IX_Tokenusage_student_date
+                ON Tokenusage (student_id, date_time) INCLUDE (tokens);
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Tokenusage_date_time')
+            CREATE INDEX IX_Tokenusage_date_time
+                ON Tokenusage (date_time) INCLUDE (student_id, tokens);
+
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenUsageMonthly')
+        BEGIN
+            CREATE TABLE TokenUsageMonthly (
+                student_id INT NOT NULL,
+                month_start DATE NOT NULL,
+                tokens BIGINT NOT NULL,
+                PRIMARY KEY (student_id, month_start)
+            );
+
+            CREATE INDEX IX_TokenUsageMonthly_month
+                ON TokenUsageMonthly (month_start) INCLUDE (tokens);
+
+            INSERT INTO TokenUsageMonthly (student_id, month_start, tokens)
+            SELECT student_id, DATEFROMPARTS(YEAR(date_time), MONTH(date_time), 1),
+                   SUM(tokens)
+            FROM Tokenusage
+            GROUP BY student_id, DATEFROMPARTS(YEAR(date_time), MONTH(date_time), 1);
+        END
+        """,
+    ),
+    (
+        4,
+        "Token reservations held while a chat request is in flight",
+        """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'TokenReservation')
+        BEGIN
+            CREATE TABLE TokenReservation (
+                id INT PRIMARY KEY IDENTITY(1,1),
+                student_id INT NOT NULL,
+                tokens INT NOT NULL,
+                expires_at DATETIME NOT NULL
+            );
+
+            CREATE INDEX IX_TokenReservation_student_expires
+                ON TokenReservation (student_id, expires_at) INCLUDE (tokens);
+        END
+        """,
+    ),
+]
+
+SQLSERVER_VERSION_TABLE = """
+IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'SchemaVersion')
+BEGIN
+    CREATE TABLE SchemaVersion (
+        version INT PRIMARY KEY,
+        description VARCHAR(200) NOT NULL,
+        applied_at DATETIME DEFAULT GETDATE()
+    );
+END
+"""
+
+# SQLite databases are created from scratch, including the tables that SQL Server
+# deployments manage outside the app. Tables live in the attached "dbo" schema.
+SQLITE_MIGRATIONS = [
+    (
+        1,
+        "Student, program, course, grade and token usage tables",
+        """
+        CREATE TABLE IF NOT EXISTS dbo.Program (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            european_credits INTEGER NOT NULL DEFAULT 180
+        );
+
+        CREATE TABLE IF NOT EXISTS dbo.Course (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            european_credits INTEGER NOT NULL,
+            program_id INTEGER REFERENCES Program (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS dbo.Student (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL UNIQUE,
+            password TEXT,
+            program_id INTEGER REFERENCES Program (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS dbo.Grade (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id INTEGER NOT NULL REFERENCES Student (id),
+            course_id INTEGER NOT NULL REFERENCES Course (id),
+            grade INTEGER,
+            feedback TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS dbo.IX_Grade_student ON Grade (student_id);
+
+        CREATE TABLE IF NOT EXISTS dbo.Tokenusage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id INTEGER NOT NULL REFERENCES Student (id),
+            tokens INTEGER NOT NULL,
+            date_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ),
+    (
+        2,
+        "Token settings with the default monthly global limit",
+        """
+        CREATE TABLE IF NOT EXISTS dbo.TokenSettings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            setting_name TEXT NOT NULL UNIQUE,
+            setting_value INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+
+        INSERT OR IGNORE INTO dbo.TokenSettings (setting_name, setting_value)
+        VALUES ('monthly_global_limit', 1000000);
+        """,
+    ),
+    (
+        3,
+        "Token usage cache for SSO users",
+        """
+        CREATE TABLE IF NOT EXISTS dbo.TokenUsageCache (
+            student_id INTEGER PRIMARY KEY,
+            usage INTEGER NOT NULL,
+            limit_value INTEGER NOT NULL,
+            percentage_used REAL NOT NULL,
+            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ),
+    (
+        4,
+        "Monthly token usage rollup and Tokenusage indexes",
+        """
+        CREATE INDEX IF NOT EXISTS dbo.IX_Tokenusage_student_date
+            ON Tokenusage (student_id, date_time, tokens);
+
+        CREATE INDEX IF NOT EXISTS dbo.IX_Tokenusage_date_time
+            ON Tokenusage (date_time, student_id, tokens);
+
+        CREATE TABLE IF NOT EXISTS dbo.TokenUsageMonthly (
+            student_id INTEGER NOT NULL,
+            month_start DATE NOT NULL,
+            tokens INTEGER NOT NULL,
+            PRIMARY KEY (student_id, month_start)
+        );
+
+        CREATE INDEX IF NOT EXISTS dbo.IX_TokenUsageMonthly_month
+            ON TokenUsageMonthly (month_start, student_id, tokens);
+
+        INSERT OR IGNORE INTO dbo.TokenUsageMonthly (student_id, month_start, tokens)
+        SELECT student_id, date(date_time, 'start of month'), SUM(tokens)
+        FROM Tokenusage
+        GROUP BY student_id, date(date_time, 'start of month');
+        """,
+    ),
+    (
+        5,
+        "Token reservations held while a chat request is in flight",
+        """
+        CREATE TABLE IF NOT EXISTS dbo.TokenReservation (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id INTEGER NOT NULL,
+            tokens INTEGER NOT NULL,
+            expires_at DATETIME NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS dbo.IX_TokenReservation_student_expires
+            ON TokenReservation (student_id, expires_at, tokens);
+        """,
+    ),
+]
+
+SQLITE_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS dbo.SchemaVersion (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def apply_migrations(conn, backend) -> list:
+    """Apply every migration of ``backend`` newer than the recorded schema version.
+
+    Returns the versions that were applied by this call.
+    """
+    cursor = conn.cursor()
+    try:
+        backend.lock_schema(cursor)
+        backend.run_script(cursor, backend.version_table)
+        conn.commit()
+
+        applied = []
+        for version, description, batch in backend.migrations:
+            backend.lock_schema(cursor)
+            cursor.execute(
+                "SELECT COUNT(*) FROM SchemaVersion WHERE version = ?;", (version,)
+            )
+            if cursor.fetchone()[0]:
+                conn.commit()
+                continue
+
+            logging.info(f"Applying schema migration {version}: {description}")
+            backend.run_script(cursor, batch)
+            cursor.execute(backend.insert_schema_version, (version, description))
+            conn.commit()
+            applied.append(version)
+    finally:
+        cursor.close()
+
+    return applied
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from clients.database_client import DatabaseClient
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    load_dotenv()
+
+    applied = DatabaseClient().ensure_schema()
+    print(f"Applied migrations: {applied or 'none, schema is up to date'}")
@@ -2,8 +2,11 @@
 Azure Search Client for document retrieval with semantic search capabilities.
 """
 
+import json
 import os
-from dotenv import load_dotenv
+import re
+from typing import List
+
 from azure.search.documents import SearchClient
 from azure.search.documents.models import (
     QueryType,
@@ -13,25 +16,103 @@ from azure.search.documents.models import (
 )
 from azure.core.credentials import AzureKeyCredential
 
+from modules.cache import JSONFileCache, TTLCache
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase ``query``, collapse whitespace and drop surrounding punctuation,
+    so that trivially different phrasings of a question share a cache entry."""
+    return re.sub(r"\s+", " ", query.casefold()).strip(" ?!.,;:")
+
 
 class AzureSearchClient:
     """Azure Search Client to query documents using semantic search."""
 
-    def __init__(self):
-        load_dotenv()
+    def __init__(
+        self,
+        transport=None,
+        result_cache: TTLCache = None,
+        disk_cache: JSONFileCache = None,
+    ):
+        """``transport`` is an optional azure-core transport, to share its connection pool.
+
+        Retrieved chunks are cached in memory, and in ``search-cache-dir`` when it
+        is set, unless specific caches are given.
+        """
         self.service_endpoint = os.environ.get("azure-search-service-endpoint")
         self.index_name = os.environ.get("azure-search-index")
         self.key = os.environ.get("azure-search-admin-key")
         self.semantic_config_name = os.environ.get("azure-search-semantic-config")
 
         self.client = SearchClient(
-            self.service_endpoint, self.index_name, AzureKeyCredential(self.key)
+            self.service_endpoint,
+            self.index_name,
+            AzureKeyCredential(self.key),
+            transport=transport,
         )
 
+        # Compared with None, since an empty cache is falsy
+        ttl = float(os.environ.get("search-cache-ttl", 900))
+        if result_cache is None:
+            result_cache = TTLCache(
+                ttl=ttl, maxsize=int(os.environ.get("search-cache-size", 1000))
+            )
+        self.result_cache = result_cache
+
+        cache_dir = os.environ.get("search-cache-dir")
+        if disk_cache is None and cache_dir:
+            disk_cache = JSONFileCache(
+                cache_dir,
+                ttl=ttl,
+                maxsize=int(os.environ.get("search-cache-disk-size", 10000)),
+            )
+        self.disk_cache = disk_cache
+
     def search_documents(
         self, query: str, k_neighbors: int = 3, top_results: int = 3
     ) -> str:
         """Performs semantic search on documents using a vectorized text query."""
+        retrieved_docs = self.search_chunks(query, k_neighbors, top_results)
+        return (
+            "\n\n".join(retrieved_docs)
+            if retrieved_docs
+            else "No relevant documents found."
+        )
+
+    def search_chunks(
+        self, query: str, k_neighbors: int = 3, top_results: int = 3
+    ) -> List[str]:
+        """Return the retrieved chunks for ``query``, from the cache when possible.
+
+        Only non-empty results are cached, so newly indexed documents show up
+        for questions that found nothing before.
+        """
+        key = json.dumps(
+            [
+                self.index_name,
+                self.semantic_config_name,
+                k_neighbors,
+                top_results,
+                normalize_query(query),
+            ]
+        )
+
+        chunks = self.result_cache.get(key)
+        if chunks is None and self.disk_cache is not None:
+            chunks = self.disk_cache.get(key)
+            if chunks is not None:
+                self.result_cache.set(key, chunks)
+        if chunks is not None:
+            return list(chunks)
+
+        chunks = self._search(query, k_neighbors, top_results)
+        if chunks:
+            self.result_cache.set(key, tuple(chunks))
+            if self.disk_cache is not None:
+                self.disk_cache.set(key, chunks)
+        return chunks
+
+    def _search(self, query: str, k_neighbors: int, top_results: int) -> List[str]:
         vector_query = VectorizableTextQuery(
             text=query,
             k_nearest_neighbors=k_neighbors,
@@ -49,14 +130,14 @@ class AzureSearchClient:
             top=top_results,
         )
 
-        retrieved_docs = [
-            result.get("chunk", "") for result in results if result.get("chunk")
-        ]
-        return (
-            "\n\n".join(retrieved_docs)
-            if retrieved_docs
-            else "No relevant documents found."
-        )
+        return [result.get("chunk", "") for result in results if result.get("chunk")]
+
+    def cache_stats(self) -> dict:
+        """Return hit/miss counters of the memory and disk result caches."""
+        return {
+            "memory": self.result_cache.stats(),
+            "disk": self.disk_cache.stats() if self.disk_cache is not None else None,
+        }
 
     def empty_method(self):
         """Placeholder method for future functionality."""
@@ -0,0 +1,529 @@
+"""
+Storage backends for DatabaseClient: connection handling and dialect-specific SQL.
+
+The backend is selected with the ``db-backend`` setting: ``sqlserver`` (default) or
+``sqlite``. Queries that are valid in both dialects live in DatabaseClient; the
+statements below are the ones that differ.
+"""
+
+import os
+import sqlite3
+from datetime import date, datetime
+
+from clients import schema
+
+# Store dates the same way on every Python version; the default adapters are deprecated
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+
+
+class StorageBackend:
+    """Connection factory, schema migrations and dialect-specific statements."""
+
+    name = None
+    ping_query = "SELECT 1;"
+
+    # Schema bootstrap, see clients/schema.py
+    migrations = ()
+    version_table = None
+    insert_schema_version = None
+
+    # Dialect-specific statements used by DatabaseClient
+    get_or_create_student = None
+    update_student_email = None
+    upsert_global_limit = None
+    upsert_usage_rollup = None
+    select_usage_cache = None
+    upsert_usage_cache = None
+    monthly_usage_page = None
+    reserve_tokens = None
+
+    # Bulk loading, see DatabaseClient.bulk_load: per kind of record, a script that
+    # (re)creates an empty staging table, the staging INSERT and the set-based
+    # statement that resolves names to ids and inserts the new rows
+    bulk_load = {}
+
+    def connect(self):
+        """Open a new DB-API connection."""
+        raise NotImplementedError
+
+    def run_script(self, cursor, script: str, name: str = None):
+        """Execute a batch that may contain several statements.
+
+        On an InstrumentedCursor, pass the query ``name`` to record the batch under.
+        """
+        if name is None:
+            cursor.execute(script)
+        else:
+            cursor.execute(name, script)
+
+    def is_integrity_error(self, error: Exception) -> bool:
+        """Return True if ``error`` is a constraint violation, e.g. a duplicate key."""
+        return False
+
+    def lock_schema(self, cursor):
+        """Serialize schema migrations between processes until the transaction ends."""
+
+    def prepare_bulk_cursor(self, cursor):
+        """Tune a cursor for large ``executemany`` calls."""
+
+
+class SqlServerBackend(StorageBackend):
+    """Azure SQL / SQL Server through the Microsoft ODBC driver."""
+
+    name = "sqlserver"
+
+    migrations = schema.SQLSERVER_MIGRATIONS
+    version_table = schema.SQLSERVER_VERSION_TABLE
+    insert_schema_version = """
+    INSERT INTO SchemaVersion (version, description) VALUES (?, ?);
+    """
+
+    # The key-range lock on the email stops a concurrent call from inserting the
+    # same student between the lookup and the insert
+    get_or_create_student = """
+    SET NOCOUNT ON;
+    DECLARE @name NVARCHAR(255) = ?, @email NVARCHAR(255) = ?,
+        @password NVARCHAR(MAX) = ?, @id INT;
+
+    SELECT TOP 1 @id = id
+    FROM dbo.Student WITH (UPDLOCK, HOLDLOCK)
+    WHERE email = @email
+    ORDER BY id;
+
+    IF @id IS NOT NULL
+        SELECT @id, 0;
+    ELSE
+    BEGIN
+        INSERT INTO dbo.Student (name, email, password)
+        VALUES (@name, @email, @password);
+        SELECT CAST(SCOPE_IDENTITY() AS INT), 1;
+    END
+    """
+
+    update_student_email = """
+    UPDATE dbo.Student
+    SET email = ?
+    OUTPUT INSERTED.id
+    WHERE email = ?;
+    """
+
+    upsert_global_limit = """
+    MERGE INTO TokenSettings AS target
+    USING (SELECT 'monthly_global_limit' AS setting_name, ? AS setting_value) AS source
+    ON target.setting_name = source.setting_name
+    WHEN MATCHED THEN
+        UPDATE SET target.setting_value = source.setting_value, target.updated_at = GETDATE()
+    WHEN NOT MATCHED THEN
+        INSERT (setting_name, setting_value)
+        VALUES (source.setting_name, source.setting_value);
+    """
+
+    upsert_usage_rollup = """
+    MERGE TokenUsageMonthly WITH (HOLDLOCK) AS target
+    USING (SELECT ? AS student_id, ? AS month_start, ? AS tokens) AS source
+    ON target.student_id = source.student_id
+        AND target.month_start = source.month_start
+    WHEN MATCHED THEN
+        UPDATE SET target.tokens = target.tokens + source.tokens
+    WHEN NOT MATCHED THEN
+        INSERT (student_id, month_start, tokens)
+        VALUES (source.student_id, source.month_start, source.tokens);
+    """
+
+    select_usage_cache = """
+    SELECT usage, limit_value, percentage_used
+    FROM TokenUsageCache
+    WHERE student_id = ?
+    AND last_updated >= DATEADD(MINUTE, -5, GETDATE());
+    """
+
+    upsert_usage_cache = """
+    MERGE TokenUsageCache AS target
+    USING (SELECT ? as student_id, ? as usage, ? as limit_value, ? as percentage_used) AS source
+    ON (target.student_id = source.student_id)
+    WHEN MATCHED THEN
+        UPDATE SET
+            usage = source.usage,
+            limit_value = source.limit_value,
+            percentage_used = source.percentage_used,
+            last_updated = GETDATE()
+    WHEN NOT MATCHED THEN
+        INSERT (student_id, usage, limit_value, percentage_used)
+        VALUES (source.student_id, source.usage, source.limit_value, source.percentage_used);
+    """
+
+    monthly_usage_page = """
+    SELECT s.id, s.email, s.name, tum.tokens AS total_tokens_used
+    FROM TokenUsageMonthly tum
+    INNER JOIN dbo.student s
+        ON s.id = tum.student_id
+    WHERE tum.month_start = ? AND tum.student_id > ?
+    ORDER BY tum.student_id
+    OFFSET 0 ROWS FETCH NEXT ? ROWS ONLY;
+    """
+
+    # The range locks on the student's rollup row and reservations serialize
+    # concurrent reservations for the same student until the transaction commits
+    reserve_tokens = """
+    SET NOCOUNT ON;
+    INSERT INTO TokenReservation (student_id, tokens, expires_at)
+    OUTPUT INSERTED.id
+    SELECT ?, ?, ?
+    WHERE COALESCE(
+            (
+                SELECT tokens FROM TokenUsageMonthly WITH (UPDLOCK, HOLDLOCK)
+                WHERE student_id = ? AND month_start = ?
+            ),
+            0
+        )
+        + COALESCE(
+            (
+                SELECT SUM(tokens) FROM TokenReservation WITH (UPDLOCK, HOLDLOCK)
+                WHERE student_id = ? AND expires_at > ?
+            ),
+            0
+        )
+        + ? <= ?;
+    """
+
+    bulk_load = {
+        "programs": (
+            """
+            IF OBJECT_ID('tempdb..#ProgramStage') IS NOT NULL DROP TABLE #ProgramStage;
+            CREATE TABLE #ProgramStage (
+                name NVARCHAR(255) NOT NULL,
+                european_credits INT NULL
+            );
+            """,
+            "INSERT INTO #ProgramStage (name, european_credits) VALUES (?, ?);",
+            """
+            INSERT INTO dbo.Program (name, european_credits)
+            SELECT st.name, COALESCE(st.european_credits, 180)
+            FROM #ProgramStage st
+            WHERE NOT EXISTS (SELECT 1 FROM dbo.Program p WHERE p.name = st.name);
+            """,
+        ),
+        "courses": (
+            """
+            IF OBJECT_ID('tempdb..#CourseStage') IS NOT NULL DROP TABLE #CourseStage;
+            CREATE TABLE #CourseStage (
+                name NVARCHAR(255) NOT NULL,
+                european_credits INT NOT NULL,
+                program_name NVARCHAR(255) NULL
+            );
+            """,
+            """
+            INSERT INTO #CourseStage (name, european_credits, program_name)
+            VALUES (?, ?, ?);
+            """,
+            """
+            INSERT INTO dbo.Course (name, european_credits, program_id)
+            SELECT st.name, st.european_credits,
+                   (SELECT MIN(p.id) FROM dbo.Program p WHERE p.name = st.program_name)
+            FROM #CourseStage st
+            WHERE NOT EXISTS (SELECT 1 FROM dbo.Course c WHERE c.name = st.name);
+            """,
+        ),
+        "students": (
+            """
+            IF OBJECT_ID('tempdb..#StudentStage') IS NOT NULL DROP TABLE #StudentStage;
+            CREATE TABLE #StudentStage (
+                name NVARCHAR(255) NOT NULL,
+                email NVARCHAR(255) NOT NULL,
+                password NVARCHAR(255) NULL,
+                program_name NVARCHAR(255) NULL
+            );
+            """,
+            """
+            INSERT INTO #StudentStage (name, email, password, program_name)
+            VALUES (?, ?, ?, ?);
+            """,
+            """
+            INSERT INTO dbo.Student (name, email, password, program_id)
+            SELECT st.name, st.email, st.password,
+                   (SELECT MIN(p.id) FROM dbo.Program p WHERE p.name = st.program_name)
+            FROM #StudentStage st
+            WHERE NOT EXISTS (SELECT 1 FROM dbo.Student s WHERE s.email = st.email);
+            """,
+        ),
+        "grades": (
+            """
+            IF OBJECT_ID('tempdb..#GradeStage') IS NOT NULL DROP TABLE #GradeStage;
+            CREATE TABLE #GradeStage (
+                email NVARCHAR(255) NOT NULL,
+                course_name NVARCHAR(255) NOT NULL,
+                grade INT NULL,
+                feedback NVARCHAR(MAX) NULL
+            );
+            """,
+            """
+            INSERT INTO #GradeStage (email, course_name, grade, feedback)
+            VALUES (?, ?, ?, ?);
+            """,
+            """
+            INSERT INTO dbo.Grade (student_id, course_id, grade, feedback)
+            SELECT s.id, c.id, st.grade, st.feedback
+            FROM #GradeStage st
+            INNER JOIN dbo.Student s ON s.email = st.email
+            INNER JOIN dbo.Course c
+                ON c.id = (SELECT MIN(id) FROM dbo.Course WHERE name = st.course_name)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM dbo.Grade g
+                WHERE g.student_id = s.id AND g.course_id = c.id
+            );
+            """,
+        ),
+    }
+
+    def connect(self):
+        """Open a connection using the sql-* credentials from the environment."""
+        # Imported here so the SQLite backend works without the ODBC driver installed
+        import pyodbc
+
+        connection_str = (
+            "DRIVER={ODBC Driver 17 for SQL Server};"
+            "SERVER=" + os.environ["sql-server"] + ";"
+            "DATABASE=" + os.environ["sql-db"] + ";"
+            "UID=" + os.environ["sql-user"] + ";"
+            "PWD=" + os.environ["sql-password"]
+        )
+        return pyodbc.connect(connection_str)
+
+    def is_integrity_error(self, error: Exception) -> bool:
+        import pyodbc
+
+        return isinstance(error, pyodbc.IntegrityError)
+
+    def lock_schema(self, cursor):
+        cursor.execute(
+            """
+            EXEC sp_getapplock @Resource = 'SchemaVersion', @LockMode = 'Exclusive',
+                @LockOwner = 'Transaction';
+            """
+        )
+
+    def prepare_bulk_cursor(self, cursor):
+        # Send executemany parameters as one array instead of a round trip per row
+        cursor.fast_executemany = True
+
+
+class SqliteBackend(StorageBackend):
+    """Embedded SQLite database, for local development, load tests and single nodes.
+
+    The database file is attached under the schema name ``dbo`` so that the
+    ``dbo.``-qualified queries shared with SQL Server resolve unchanged.
+    """
+
+    name = "sqlite"
+
+    migrations = schema.SQLITE_MIGRATIONS
+    version_table = schema.SQLITE_VERSION_TABLE
+    insert_schema_version = """
+    INSERT OR IGNORE INTO SchemaVersion (version, description) VALUES (?, ?);
+    """
+
+    # Returns no row when the email is already registered
+    get_or_create_student = """
+    INSERT INTO Student (name, email, password)
+    VALUES (?, ?, ?)
+    ON CONFLICT (email) DO NOTHING
+    RETURNING id, 1;
+    """
+
+    update_student_email = """
+    UPDATE Student
+    SET email = ?
+    WHERE email = ?
+    RETURNING id;
+    """
+
+    upsert_global_limit = """
+    INSERT INTO TokenSettings (setting_name, setting_value)
+    VALUES ('monthly_global_limit', ?)
+    ON CONFLICT (setting_name) DO UPDATE SET
+        setting_value = excluded.setting_value,
+        updated_at = CURRENT_TIMESTAMP;
+    """
+
+    upsert_usage_rollup = """
+    INSERT INTO TokenUsageMonthly (student_id, month_start, tokens)
+    VALUES (?, ?, ?)
+    ON CONFLICT (student_id, month_start) DO UPDATE SET
+        tokens = tokens + excluded.tokens;
+    """
+
+    select_usage_cache = """
+    SELECT usage, limit_value, percentage_used
+    FROM TokenUsageCache
+    WHERE student_id = ?
+    AND last_updated >= datetime('now', '-5 minutes');
+    """
+
+    upsert_usage_cache = """
+    INSERT INTO TokenUsageCache (student_id, usage, limit_value, percentage_used)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (student_id) DO UPDATE SET
+        usage = excluded.usage,
+        limit_value = excluded.limit_value,
+        percentage_used = excluded.percentage_used,
+        last_updated = CURRENT_TIMESTAMP;
+    """
+
+    monthly_usage_page = """
+    SELECT s.id, s.email, s.name, tum.tokens AS total_tokens_used
+    FROM TokenUsageMonthly tum
+    INNER JOIN dbo.student s
+        ON s.id = tum.student_id
+    WHERE tum.month_start = ? AND tum.student_id > ?
+    ORDER BY tum.student_id
+    LIMIT ?;
+    """
+
+    # Write statements take the database write lock before reading, so the check
+    # and the insert cannot interleave with another reservation
+    reserve_tokens = """
+    INSERT INTO TokenReservation (student_id, tokens, expires_at)
+    SELECT ?, ?, ?
+    WHERE COALESCE(
+            (
+                SELECT tokens FROM TokenUsageMonthly
+                WHERE student_id = ? AND month_start = ?
+            ),
+            0
+        )
+        + COALESCE(
+            (
+                SELECT SUM(tokens) FROM TokenReservation
+                WHERE student_id = ? AND expires_at > ?
+            ),
+            0
+        )
+        + ? <= ?
+    RETURNING id;
+    """
+
+    # Staging tables are created in the connection's temp schema
+    bulk_load = {
+        "programs": (
+            """
+            DROP TABLE IF EXISTS temp.ProgramStage;
+            CREATE TEMP TABLE ProgramStage (
+                name TEXT NOT NULL,
+                european_credits INTEGER NULL
+            );
+            """,
+            "INSERT INTO ProgramStage (name, european_credits) VALUES (?, ?);",
+            """
+            INSERT INTO dbo.Program (name, european_credits)
+            SELECT st.name, COALESCE(st.european_credits, 180)
+            FROM ProgramStage st
+            WHERE NOT EXISTS (SELECT 1 FROM dbo.Program p WHERE p.name = st.name);
+            """,
+        ),
+        "courses": (
+            """
+            DROP TABLE IF EXISTS temp.CourseStage;
+            CREATE TEMP TABLE CourseStage (
+                name TEXT NOT NULL,
+                european_credits INTEGER NOT NULL,
+                program_name TEXT NULL
+            );
+            """,
+            """
+            INSERT INTO CourseStage (name, european_credits, program_name)
+            VALUES (?, ?, ?);
+            """,
+            """
+            INSERT INTO dbo.Course (name, european_credits, program_id)
+            SELECT st.name, st.european_credits,
+                   (SELECT MIN(p.id) FROM dbo.Program p WHERE p.name = st.program_name)
+            FROM CourseStage st
+            WHERE NOT EXISTS (SELECT 1 FROM dbo.Course c WHERE c.name = st.name);
+            """,
+        ),
+        "students": (
+            """
+            DROP TABLE IF EXISTS temp.StudentStage;
+            CREATE TEMP TABLE StudentStage (
+                name TEXT NOT NULL,
+                email TEXT NOT NULL,
+                password TEXT NULL,
+                program_name TEXT NULL
+            );
+            """,
+            """
+            INSERT INTO StudentStage (name, email, password, program_name)
+            VALUES (?, ?, ?, ?);
+            """,
+            """
+            INSERT INTO dbo.Student (name, email, password, program_id)
+            SELECT st.name, st.email, st.password,
+                   (SELECT MIN(p.id) FROM dbo.Program p WHERE p.name = st.program_name)
+            FROM StudentStage st
+            WHERE NOT EXISTS (SELECT 1 FROM dbo.Student s WHERE s.email = st.email);
+            """,
+        ),
+        "grades": (
+            """
+            DROP TABLE IF EXISTS temp.GradeStage;
+            CREATE TEMP TABLE GradeStage (
+                email TEXT NOT NULL,
+                course_name TEXT NOT NULL,
+                grade INTEGER NULL,
+                feedback TEXT NULL
+            );
+            """,
+            """
+            INSERT INTO GradeStage (email, course_name, grade, feedback)
+            VALUES (?, ?, ?, ?);
+            """,
+            """
+            INSERT INTO dbo.Grade (student_id, course_id, grade, feedback)
+            SELECT s.id, c.id, st.grade, st.feedback
+            FROM GradeStage st
+            INNER JOIN dbo.Student s ON s.email = st.email
+            INNER JOIN dbo.Course c
+                ON c.id = (SELECT MIN(id) FROM dbo.Course WHERE name = st.course_name)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM dbo.Grade g
+                WHERE g.student_id = s.id AND g.course_id = c.id
+            );
+            """,
+        ),
+    }
+
+    def __init__(self, path: str = None):
+        self.path = path or os.environ.get("sqlite-path", "studentwhisperer.db")
+
+    def connect(self):
+        """Open a connection to the database file, attached as ``dbo``."""
+        # Pooled connections move between threads, but only one thread uses each at a time
+        conn = sqlite3.connect(":memory:", timeout=30, check_same_thread=False)
+        conn.execute("ATTACH DATABASE ? AS dbo;", (self.path,))
+        conn.execute("PRAGMA dbo.journal_mode = WAL;")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        return conn
+
+    def is_integrity_error(self, error: Exception) -> bool:
+        return isinstance(error, sqlite3.IntegrityError)
+
+    def run_script(self, cursor, script: str, name: str = None):
+        # executescript is not instrumented, so the name is not needed
+        cursor.executescript(script)
+
+
+BACKENDS = {
+    SqlServerBackend.name: SqlServerBackend,
+    SqliteBackend.name: SqliteBackend,
+}
+
+
+def create_backend(name: str = None) -> StorageBackend:
+    """Create the backend named by ``name`` or the ``db-backend`` setting."""
+    name = (name or os.environ.get("db-backend") or SqlServerBackend.name).lower()
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown db-backend '{name}', expected one of: {', '.join(BACKENDS)}"
+        )
+    return BACKENDS[name]()
@@ -0,0 +1,171 @@
+"""
+Write-behind buffer that batches token usage records off the request path.
+"""
+
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from datetime import date, datetime
+
+
+class UsageRecorder:
+    """Collect token usage in memory and write it to the database in batches.
+
+    A background thread flushes the buffer every ``flush_interval`` seconds, or as
+    soon as ``batch_size`` records are waiting. Tokens that were recorded but not
+    yet written are reported by ``pending_tokens`` so quota checks can include
+    them. Records that settle a token reservation carry its id so the writer can
+    replace the reservation in the same transaction. The buffer is drained when
+    the process exits.
+    """
+
+    def __init__(
+        self,
+        writer,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_buffer: int = 10000,
+    ):
+        """``writer`` is called with a list of
+        ``(student_id, tokens, recorded_at, reservation_id)`` tuples."""
+        self._writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self._buffer = []
+        self._pending = defaultdict(int)
+        self._pending_unreserved = defaultdict(int)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self._flushes = 0
+        self._written = 0
+        self._failures = 0
+        self._dropped = 0
+
+        atexit.register(self.close)
+
+    def record(self, student_id: int, tokens: int, reservation_id: int = None):
+        """Queue a usage record; it is written by the background thread."""
+        recorded_at = datetime.now()
+
+        with self._lock:
+            self._buffer.append((student_id, tokens, recorded_at, reservation_id))
+            self._remember(student_id, tokens, recorded_at, reservation_id)
+            buffered = len(self._buffer)
+
+            if not self._stopped.is_set() and (
+                self._thread is None or not self._thread.is_alive()
+            ):
+                self._start()
+
+        if self._stopped.is_set():
+            # Late records during shutdown are written synchronously
+            self.flush()
+        elif buffered >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_tokens(
+        self, student_id: int, month_start: date, include_reserved: bool = True
+    ) -> int:
+        """Tokens recorded for a student in a month that are not yet in the database.
+
+        With ``include_reserved=False`` only records that do not settle a token
+        reservation are counted, since the reservation still holds the others.
+        """
+        pending = self._pending if include_reserved else self._pending_unreserved
+        with self._lock:
+            return pending.get((student_id, month_start), 0)
+
+    def _start(self):
+        # Started lazily so each forked worker gets its own flusher thread
+        self._thread = threading.Thread(
+            target=self._run, name="usage-recorder", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing token usage: {e}")
+
+    def flush(self):
+        """Write every buffered record now, in one batch."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+
+            if not batch:
+                return
+
+            try:
+                self._writer(batch)
+            except Exception:
+                with self._lock:
+                    self._failures += 1
+                    # Keep the records for the next attempt, up to max_buffer
+                    self._buffer = batch + self._buffer
+                    overflow = len(self._buffer) - self.max_buffer
+                    if overflow > 0:
+                        for record in self._buffer[:overflow]:
+                            self._forget(*record)
+                        self._buffer = self._buffer[overflow:]
+                        self._dropped += overflow
+                        logging.error(
+                            f"Dropped {overflow} unwritten token usage records"
+                        )
+                raise
+
+            with self._lock:
+                for record in batch:
+                    self._forget(*record)
+                self._flushes += 1
+                self._written += len(batch)
+
+    def _remember(self, student_id, tokens, recorded_at, reservation_id):
+        key = (student_id, date(recorded_at.year, recorded_at.month, 1))
+        self._pending[key] += tokens
+        if reservation_id is None:
+            self._pending_unreserved[key] += tokens
+
+    def _forget(self, student_id, tokens, recorded_at, reservation_id):
+        key = (student_id, date(recorded_at.year, recorded_at.month, 1))
+        pending_maps = [self._pending]
+        if reservation_id is None:
+            pending_maps.append(self._pending_unreserved)
+        for pending in pending_maps:
+            pending[key] -= tokens
+            if pending[key] <= 0:
+                del pending[key]
+
+    def close(self):
+        """Stop the background thread and write whatever is still buffered."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval + 5)
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error(f"Error draining token usage on shutdown: {e}")
+
+    def stats(self) -> dict:
+        """Return buffer size and flush counters."""
+        with self._lock:
+            return {
+                "pending_records": len(self._buffer),
+                "flushes": self._flushes,
+                "written": self._written,
+                "failures": self._failures,
+                "dropped": self._dropped,
+            }
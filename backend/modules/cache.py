@@ -0,0 +1,293 @@
+"""
+In-process and on-disk caches with TTL expiry, LRU eviction and cross-process invalidation.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class FileInvalidationChannel:
+    """Broadcast cache invalidations between worker processes through a shared file.
+
+    Publishing rewrites the file, which bumps its modification time. Subscribers
+    compare the modification time against the last one they saw, which costs a
+    single ``stat`` call per check.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._last_seen = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def publish(self):
+        """Tell every subscriber, in this and other processes, to drop its entries."""
+        with open(self.path, "w") as f:
+            f.write(str(time.time_ns()))
+
+        # Our own subscribers have already applied the invalidation locally
+        mtime = self._mtime()
+        with self._lock:
+            self._last_seen = mtime
+
+    def changed(self) -> bool:
+        """Return True once for every publish since the previous call."""
+        mtime = self._mtime()
+        with self._lock:
+            if mtime == self._last_seen:
+                return False
+            self._last_seen = mtime
+            return True
+
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire after ``ttl`` seconds.
+
+    When ``maxsize`` is set the least recently used entry is evicted once the
+    cache is full, in constant time. Expired entries are swept out on writes at
+    most once per ``ttl``. When a ``channel`` is given, the whole cache is cleared
+    whenever another process publishes an invalidation, and local invalidations
+    are published to the other processes.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = None, channel=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.channel = channel
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for ``key``, or ``default`` if missing or expired."""
+        if self.channel is not None and self.channel.changed():
+            self.clear()
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """Store ``value`` under ``key``, optionally overriding the default TTL."""
+        now = time.monotonic()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+
+    def sweep(self) -> int:
+        """Drop every expired entry and return how many were dropped."""
+        with self._lock:
+            return self._sweep(time.monotonic())
+
+    def _sweep(self, now: float) -> int:
+        expired = [
+            key for key, (_, expires_at) in self._data.items() if expires_at <= now
+        ]
+        for key in expired:
+            del self._data[key]
+        self.expirations += len(expired)
+        self._next_sweep = now + self.ttl
+        return len(expired)
+
+    def invalidate(self, key=None):
+        """Drop ``key`` (or every entry if no key is given) here and in other processes."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+        if self.channel is not None:
+            self.channel.publish()
+
+    def clear(self):
+        """Drop every entry in this process only."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Return hit, miss, eviction and expiration counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class JSONFileCache:
+    """Cache of JSON-serializable values stored as one file per key in ``directory``.
+
+    Entries survive restarts and are shared by every worker process on the host.
+    Files are written atomically and expire after ``ttl`` seconds of wall-clock
+    time. At most once per ``ttl``, on writes, expired files are removed and the
+    oldest ones are dropped until no more than ``maxsize`` remain.
+    """
+
+    def __init__(self, directory: str, ttl: float, maxsize: int = None):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + ttl
+        os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, key: str, default=None):
+        """Return the cached value for ``key``, or ``default`` if missing or expired."""
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+        except (OSError, ValueError):
+            self.errors += 1
+            self.misses += 1
+            return default
+
+        # The digest could collide, so the key is stored alongside the value
+        if entry.get("key") != key or entry.get("expires_at", 0) <= time.time():
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return entry.get("value")
+
+    def set(self, key: str, value, ttl: float = None):
+        """Store ``value`` under ``key``, optionally overriding the default TTL."""
+        entry = {
+            "key": key,
+            "value": value,
+            "expires_at": time.time() + (self.ttl if ttl is None else ttl),
+        }
+        path = self._path(key)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError):
+            self.errors += 1
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.writes += 1
+
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            with self._lock:
+                if now >= self._next_sweep:
+                    self._next_sweep = now + self.ttl
+                    self.sweep()
+
+    def sweep(self) -> int:
+        """Remove expired files and the oldest ones beyond ``maxsize``; return how many.
+
+        Temporary files left behind by a writer that crashed are removed too.
+        """
+        files = []
+        temporary = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".json", ".tmp")):
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if entry.name.endswith(".json"):
+                    files.append((mtime, entry.path))
+                else:
+                    temporary.append((mtime, entry.path))
+
+        # Files are rewritten on every set, so the modification time is the write time
+        now = time.time()
+        cutoff = now - self.ttl
+        files.sort()
+        expired = [path for mtime, path in files if mtime <= cutoff]
+
+        # Leave a grace period for writes that are still in progress
+        tmp_cutoff = now - max(self.ttl, 60)
+        expired.extend(path for mtime, path in temporary if mtime <= tmp_cutoff)
+        live = [path for mtime, path in files if mtime > cutoff]
+        if self.maxsize is not None and len(live) > self.maxsize:
+            evicted = live[: len(live) - self.maxsize]
+            self.evictions += len(evicted)
+            expired.extend(evicted)
+
+        removed = 0
+        for path in expired:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def stats(self) -> dict:
+        """Return hit, miss, write and error counters."""
+        lookups = self.hits + self.misses
+        return {
+            "directory": self.directory,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "errors": self.errors,
+            "evictions": self.evictions,
+        }
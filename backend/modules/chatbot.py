@@ -2,18 +2,146 @@
 Chatbot application for University of Amsterdam students using OpenAI and Azure Search.
 """
 
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Optional
+
+import tiktoken
+
 from clients.search_client import AzureSearchClient
 from clients.openai_client import OpenAIClient
 from clients.database_client import DatabaseClient
+from clients.registry import get_openai_client, get_search_client
+from modules.prompt_assembler import PromptAssembler
+from modules.semantic_cache import GLOBAL_SCOPE, SemanticCache
+
+# Result of a context source that failed or did not answer in time
+UNAVAILABLE = object()
+
+# First-person words that make a prompt depend on the student who asks it
+PERSONAL_PROMPT = re.compile(
+    r"\b(i|i'm|i've|i'd|i'll|me|my|mine|myself|we|our|ours|us)\b", re.IGNORECASE
+)
+
+# Chatbot, retrieval stage thread pool and response cache shared by every request
+# in this process
+_shared_chatbot = None
+_retrieval_executor = None
+_response_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    """Return the process-wide thread pool that fetches context sources."""
+    global _retrieval_executor
+
+    if _retrieval_executor is None:
+        with _shared_lock:
+            if _retrieval_executor is None:
+                _retrieval_executor = ThreadPoolExecutor(
+                    max_workers=int(os.environ.get("retrieval-workers", 16)),
+                    thread_name_prefix="retrieval",
+                )
+    return _retrieval_executor
+
+
+def get_response_cache() -> Optional[SemanticCache]:
+    """Return the process-wide cache of answers by prompt similarity.
+
+    Returns None when no embedding deployment is configured or semantic-cache-size
+    is 0, which disables the cache.
+    """
+    global _response_cache
+
+    if not os.environ.get("azure-openai-embedding-deployment-id"):
+        return None
+    maxsize = int(os.environ.get("semantic-cache-size", 2000))
+    if maxsize <= 0:
+        return None
+
+    if _response_cache is None:
+        with _shared_lock:
+            if _response_cache is None:
+                _response_cache = SemanticCache(
+                    threshold=float(os.environ.get("semantic-cache-threshold", 0.95)),
+                    maxsize=maxsize,
+                    ttl=float(os.environ.get("semantic-cache-ttl", 3600)),
+                )
+    return _response_cache
+
+
+def response_cache_stats():
+    """Return the stats of the shared response cache, if it was created."""
+    response_cache = _response_cache
+    return response_cache.stats() if response_cache is not None else None
+
+
+def prompt_assembly_stats():
+    """Return the prompt token stats of the shared chatbot, if it was created."""
+    chatbot = _shared_chatbot
+    return chatbot.prompt_assembler.stats() if chatbot is not None else None
+
+
+def get_chatbot() -> "OpenAIChatbot":
+    """Return the process-wide chatbot built on the shared clients."""
+    global _shared_chatbot
+
+    if _shared_chatbot is None:
+        with _shared_lock:
+            if _shared_chatbot is None:
+                _shared_chatbot = OpenAIChatbot(
+                    openai_client=get_openai_client(),
+                    search_client=get_search_client(),
+                    response_cache=get_response_cache(),
+                )
+    return _shared_chatbot
 
 
 class OpenAIChatbot:
     """Chatbot interface using Streamlit and Azure APIs."""
 
-    def __init__(self):
-        self.openai_client = OpenAIClient()
-        self.search_client = AzureSearchClient()
-        self.database_client = DatabaseClient()
+    def __init__(
+        self,
+        openai_client: OpenAIClient = None,
+        search_client: AzureSearchClient = None,
+        database_client: DatabaseClient = None,
+        response_cache: SemanticCache = None,
+    ):
+        """Use the given clients, or create new ones. The chatbot keeps no per-request
+        state, so one instance can serve every request. Answers are only cached
+        when a ``response_cache`` is given."""
+        self.openai_client = openai_client or OpenAIClient()
+        self.search_client = search_client or AzureSearchClient()
+        self.database_client = database_client or DatabaseClient()
+        self.response_cache = response_cache
+
+        # tiktoken caches encodings, so this is the encoder the app already loaded
+        self.prompt_assembler = PromptAssembler(
+            tiktoken.encoding_for_model("gpt-4o"),
+            budget=int(os.environ.get("prompt-token-budget", 4000)),
+            student_budget=int(os.environ.get("prompt-student-tokens", 600)),
+            search_budget=int(os.environ.get("prompt-search-tokens", 2000)),
+        )
+
+        # Context sources fetched concurrently before every completion:
+        # name -> (fetch(prompt, student_id), timeout in seconds)
+        self.context_sources = {
+            "student": (
+                lambda prompt, student_id: self.database_client.get_student_info(
+                    student_id
+                ),
+                float(os.environ.get("retrieval-student-timeout", 2)),
+            ),
+            "search": (
+                lambda prompt, student_id: self.search_client.search_chunks(prompt),
+                float(os.environ.get("retrieval-search-timeout", 5)),
+            ),
+        }
         self.system_prompt = {
             "role": "system",
             "content": (
@@ -28,11 +156,125 @@ class OpenAIChatbot:
         self, prompt: str, student_id: int, chat_history: list
     ) -> str:
         """Generate a response including session chat history."""
-        # Retrieve student information
-        student = self.database_client.get_student_info(student_id)
+        answer, embedding, generic = self._cached_answer(
+            prompt, student_id, chat_history
+        )
+        if answer is not None:
+            return answer
+
+        context = self.retrieve_context(prompt, student_id, generic)
+        messages = self._build_messages(prompt, student_id, chat_history, context)
+        answer = self.openai_client.generate_response(messages)
+        self._cache_answer(embedding, answer, student_id, context, generic)
+        return answer
+
+    def stream_response(self, prompt: str, student_id: int, chat_history: list):
+        """Generate a response like generate_response, yielding it in pieces."""
+        answer, embedding, generic = self._cached_answer(
+            prompt, student_id, chat_history
+        )
+        if answer is not None:
+            yield answer
+            return
+
+        context = self.retrieve_context(prompt, student_id, generic)
+        messages = self._build_messages(prompt, student_id, chat_history, context)
+        pieces = []
+        for delta in self.openai_client.stream_response(messages):
+            pieces.append(delta)
+            yield delta
+
+        # Only reached when the whole answer was generated and consumed
+        self._cache_answer(embedding, "".join(pieces), student_id, context, generic)
+
+    def _cached_answer(self, prompt: str, student_id: int, chat_history: list):
+        """Return a cached answer to a similar prompt, the prompt's embedding and
+        whether the prompt is generic.
+
+        Follow-up questions depend on the conversation, so only the first prompt
+        of a conversation is looked up. A first prompt without first-person words
+        is generic: it is answered without student context, so that the answer
+        can be shared with every student. The answer and embedding are None and
+        the prompt is not generic when the cache is not used.
+        """
+        if self.response_cache is None or chat_history:
+            return None, None, False
+
+        try:
+            embedding = self.openai_client.embed(prompt)
+        except Exception as e:
+            logging.warning(
+                f"Prompt embedding failed, skipping the response cache: {e}"
+            )
+            return None, None, False
+
+        generic = PERSONAL_PROMPT.search(prompt) is None
+        answer = self.response_cache.lookup(embedding, (GLOBAL_SCOPE, student_id))
+        return answer, embedding, generic
 
-        # Handle case where student information is not found
-        if student is None:
+    def _cache_answer(
+        self, embedding, answer: str, student_id: int, context: dict, generic: bool
+    ):
+        """Cache a generic ``answer`` for every student, and any other for this
+        student only. Answers made while a context source was unavailable are not
+        cached."""
+        if embedding is None or not answer or context["search"] is UNAVAILABLE:
+            return
+
+        if generic:
+            # Built without student context, see retrieve_context
+            self.response_cache.store(embedding, answer, GLOBAL_SCOPE)
+        elif context["student"] is not UNAVAILABLE:
+            self.response_cache.store(embedding, answer, student_id)
+
+    def retrieve_context(
+        self, prompt: str, student_id: int, generic: bool = False
+    ) -> dict:
+        """Fetch every context source concurrently.
+
+        Returns the result per source name, or UNAVAILABLE for sources that failed
+        or did not finish within their timeout, so a slow source does not hold up
+        the answer. For a ``generic`` prompt the student source is skipped.
+        """
+        executor = get_retrieval_executor()
+        start = time.monotonic()
+        futures = {
+            name: executor.submit(fetch, prompt, student_id)
+            for name, (fetch, _) in self.context_sources.items()
+            if not (generic and name == "student")
+        }
+
+        context = {}
+        for name, future in futures.items():
+            timeout = self.context_sources[name][1]
+            try:
+                context[name] = future.result(
+                    timeout=max(start + timeout - time.monotonic(), 0)
+                )
+            except FutureTimeoutError:
+                future.cancel()
+                logging.warning(f"Context source {name} timed out after {timeout}s")
+                context[name] = UNAVAILABLE
+            except Exception as e:
+                logging.warning(f"Context source {name} failed: {e}")
+                context[name] = UNAVAILABLE
+        return context
+
+    def _build_messages(
+        self, prompt: str, student_id: int, chat_history: list, context: dict
+    ) -> list:
+        """Build the model messages within the prompt token budget: instructions, the
+        retrieved student and search context, session chat history and the new
+        prompt."""
+        student = context.get("student", UNAVAILABLE)
+        course_lines = []
+
+        # Handle case where student information is not found or not fetched
+        if "student" not in context:
+            student_context = ""
+        elif student is UNAVAILABLE:
+            student_context = "Student Information:\n- Not available at the moment\n"
+        elif student is None:
             student_context = "Student Information:\n- New User (No course information available yet)\n"
         else:
             # Build student context with available information
@@ -44,35 +286,24 @@ class OpenAIChatbot:
             )
 
             if student.courses:
-                for course in student.courses:
-                    student_context += (
-                        f"  - {course['course_name']}: {course['grade']}\n"
-                    )
+                course_lines = [
+                    f"  - {course.name}: {course.grade}\n" for course in student.courses
+                ]
             else:
                 student_context += "  - No course information available yet\n"
 
-        # Search for relevant context
-        search_results = self.search_client.search_documents(prompt)
-        context_message = (
-            {
-                "role": "system",
-                "content": f"{student_context}\nRelevant information from search:\n{search_results}",
-            }
-            if search_results.strip()
-            else None
-        )
-
-        # Prepare message history
-        messages_with_context = [self.system_prompt]
-        if context_message:
-            messages_with_context.append(context_message)
+        # Relevant documents from search, best first
+        chunks = context["search"]
+        if chunks is UNAVAILABLE:
+            chunks = []
 
-        # Add session chat history (kept in Flask session)
-        messages_with_context.extend(chat_history)
-
-        # Append new user message
-        messages_with_context.append({"role": "user", "content": prompt})
-
-        # Generate response
-        response = self.openai_client.generate_response(messages_with_context)
-        return response
+        messages, breakdown = self.prompt_assembler.assemble(
+            self.system_prompt,
+            student_context,
+            course_lines,
+            chunks,
+            chat_history,
+            prompt,
+        )
+        logging.info(f"Prompt tokens for student {student_id}: {breakdown}")
+        return messages
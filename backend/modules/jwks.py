@@ -0,0 +1,135 @@
+"""
+Signing keys of a JSON Web Key Set, parsed once per fetch and refreshed off the request path.
+"""
+
+import json
+import logging
+import threading
+import time
+
+import requests
+from jwt.algorithms import RSAAlgorithm
+
+
+class JWKSKeyStore:
+    """Map of key id to parsed RSA public key, fetched from a JWKS endpoint.
+
+    Keys are refreshed in a background thread once they are older than
+    ``max_age - refresh_ahead`` seconds. A token signed with an unknown key id
+    triggers a refresh, but only one thread fetches at a time and at most once
+    per ``min_refresh_interval`` seconds. If a fetch fails the previous keys
+    stay in use.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        max_age: float = 86400,
+        refresh_ahead: float = 3600,
+        min_refresh_interval: float = 60,
+        timeout: float = 15,
+    ):
+        self.url = url
+        self.max_age = max_age
+        self.refresh_ahead = refresh_ahead
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self._keys = None
+        self._fetched_at = None
+        self._attempted_at = None
+        self._generation = 0
+        self._refresh_lock = threading.Lock()
+        self._background_lock = threading.Lock()
+        self._background = None
+
+        # Metrics
+        self.fetches = 0
+        self.failures = 0
+
+    def get_key(self, kid: str):
+        """Return the public key for ``kid``, or None if the key set does not have it.
+
+        Raises if the keys have never been fetched successfully.
+        """
+        if self._keys is None:
+            self._refresh(self._generation, rate_limited=True)
+            if self._keys is None:
+                raise RuntimeError("No JWKS keys available")
+        elif time.monotonic() - self._fetched_at > self.max_age - self.refresh_ahead:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # The signing keys may have been rotated since the last fetch
+            self._refresh(self._generation, rate_limited=True)
+            key = self._keys.get(kid)
+        return key
+
+    def _refresh_in_background(self):
+        with self._background_lock:
+            if self._background is not None and self._background.is_alive():
+                return
+            if (
+                self._attempted_at is not None
+                and time.monotonic() - self._attempted_at < self.min_refresh_interval
+            ):
+                return
+            self._background = threading.Thread(
+                target=self._refresh,
+                args=(self._generation, True),
+                name="jwks-refresh",
+                daemon=True,
+            )
+            self._background.start()
+
+    def _refresh(self, generation: int, rate_limited: bool = False):
+        with self._refresh_lock:
+            # Another thread refreshed while this one was waiting for the lock
+            if self._generation != generation:
+                return
+
+            now = time.monotonic()
+            if (
+                rate_limited
+                and self._attempted_at is not None
+                and now - self._attempted_at < self.min_refresh_interval
+            ):
+                return
+            self._attempted_at = now
+
+            logging.info("Fetching new JWKS keys from Microsoft")
+            try:
+                response = requests.get(self.url, timeout=self.timeout)
+                response.raise_for_status()  # Raises an HTTPError for bad responses
+                keys = self._parse(response.json()["keys"])
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"Error fetching JWKS keys: {e}")
+                return
+
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            self._generation += 1
+            self.fetches += 1
+
+    @staticmethod
+    def _parse(jwks: list) -> dict:
+        keys = {}
+        for jwk in jwks:
+            try:
+                keys[jwk["kid"]] = RSAAlgorithm.from_jwk(json.dumps(jwk))
+            except Exception as e:
+                logging.warning(f"Skipping unusable JWKS key {jwk.get('kid')}: {e}")
+        return keys
+
+    def stats(self) -> dict:
+        """Return the number of keys, their age and fetch counters."""
+        return {
+            "keys": len(self._keys or {}),
+            "age": round(time.monotonic() - self._fetched_at, 1)
+            if self._fetched_at is not None
+            else None,
+            "fetches": self.fetches,
+            "failures": self.failures,
+        }
@@ -0,0 +1,148 @@
+"""
+Password hashing in a process pool, so slow hashes do not hold the GIL of a web worker.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full or a hash does not finish in time."""
+
+
+class PasswordHasher:
+    """Hash and verify passwords with werkzeug in a pool of worker processes.
+
+    At most ``max_pending`` calls are queued or running at once; further calls
+    fail fast with PasswordHasherBusy, as do calls that take longer than
+    ``timeout`` seconds. ``method`` is passed to ``generate_password_hash``, and
+    hashes made with any other method or cost are reported by ``needs_rehash``.
+    """
+
+    def __init__(
+        self,
+        method: str = "scrypt",
+        workers: int = None,
+        max_pending: int = 32,
+        timeout: float = 10,
+    ):
+        self.method = method
+        self.workers = workers or min(2, os.cpu_count() or 1)
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._method_prefix = None
+
+        # Metrics
+        self.calls = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+        atexit.register(self.close)
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordHasherBusy("Too many password hashes in progress")
+
+        try:
+            with self._lock:
+                if self._executor is None:
+                    # Spawned rather than forked, since the web worker runs threads
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                executor = self._executor
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool as exc:
+            self._slots.release()
+            self._reset(executor)
+            raise PasswordHasherBusy("Password hashing pool is restarting") from exc
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        self.calls += 1
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError as exc:
+            future.cancel()
+            self.timeouts += 1
+            raise PasswordHasherBusy("Password hashing timed out") from exc
+        except BrokenProcessPool as exc:
+            self._reset(executor)
+            raise PasswordHasherBusy("Password hashing pool is restarting") from exc
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        logging.error("Password hashing pool broke down, starting a new one")
+        executor.shutdown(wait=False)
+
+    def hash(self, password: str) -> str:
+        """Return a salted hash of ``password`` using the configured method."""
+        return self._submit(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash: str, password: str) -> bool:
+        """Check ``password`` against a hash made by any supported method."""
+        return self._submit(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """Return True if ``pwhash`` was not made with the current method and cost."""
+        if self._method_prefix is None:
+            # werkzeug fills in default costs, e.g. "scrypt" becomes "scrypt:32768:8:1"
+            self._method_prefix = self.hash("").split("$", 1)[0]
+        return pwhash.split("$", 1)[0] != self._method_prefix
+
+    def close(self):
+        """Shut down the worker processes."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        """Return call, rejection and timeout counters."""
+        return {
+            "method": self.method,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+_shared_hasher = None
+_shared_lock = threading.Lock()
+
+
+def get_password_hasher() -> PasswordHasher:
+    """Return the process-wide hasher configured by the password-hash-* settings."""
+    global _shared_hasher
+
+    if _shared_hasher is None:
+        with _shared_lock:
+            if _shared_hasher is None:
+                _shared_hasher = PasswordHasher(
+                    method=os.environ.get("password-hash-method", "scrypt"),
+                    workers=int(os.environ.get("password-hash-workers", 0)) or None,
+                    max_pending=int(os.environ.get("password-hash-queue", 32)),
+                    timeout=float(os.environ.get("password-hash-timeout", 10)),
+                )
+    return _shared_hasher
@@ -0,0 +1,166 @@
+"""
+Assembly of chat completion messages within a token budget.
+"""
+
+import threading
+from typing import List, Tuple
+
+# Tokens the chat format adds around every message, and once to prime the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+SEARCH_LABEL = "\nRelevant information from search:\n"
+
+SECTIONS = ("system", "student", "search", "history", "prompt")
+
+
+class PromptAssembler:
+    """Fit the chatbot's instructions, context, history and prompt into ``budget`` tokens.
+
+    The instructions and the new prompt are always sent. The student context gets
+    at most ``student_budget`` tokens and the search chunks at most
+    ``search_budget``, both within what the budget leaves; the chat history gets
+    the rest. Sections are trimmed from their least useful end: the last course
+    lines of the student context, the lowest-ranked search chunks and the oldest
+    history messages.
+    """
+
+    def __init__(
+        self,
+        encoder,
+        budget: int = 4000,
+        student_budget: int = 600,
+        search_budget: int = 2000,
+    ):
+        self.encoder = encoder
+        self.budget = budget
+        self.student_budget = student_budget
+        self.search_budget = search_budget
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.requests = 0
+        self.tokens = dict.fromkeys(SECTIONS, 0)
+        self.dropped = {"courses": 0, "chunks": 0, "history": 0}
+        self.over_budget = 0
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens in ``text``."""
+        return len(self.encoder.encode(text))
+
+    def _message_tokens(self, message: dict) -> int:
+        return TOKENS_PER_MESSAGE + self.count(message["content"])
+
+    def assemble(
+        self,
+        system_prompt: dict,
+        student_header: str,
+        course_lines: List[str],
+        chunks: List[str],
+        chat_history: list,
+        prompt: str,
+    ) -> Tuple[list, dict]:
+        """Return the messages to send and their token breakdown.
+
+        ``course_lines`` are appended to ``student_header`` while they fit, and
+        ``chunks`` are expected best first. The breakdown holds the tokens per
+        section, the total, and how many courses, chunks and history messages
+        were left out.
+        """
+        user_message = {"role": "user", "content": prompt}
+        breakdown = {
+            "system": self._message_tokens(system_prompt),
+            "prompt": self._message_tokens(user_message),
+        }
+        remaining = self.budget - TOKENS_PER_REPLY - sum(breakdown.values())
+
+        # Context message: student information, then the best search chunks
+        student_tokens = (
+            TOKENS_PER_MESSAGE + self.count(student_header) + self.count(SEARCH_LABEL)
+        )
+        student_limit = min(self.student_budget, remaining)
+        kept_courses = []
+        for line in course_lines:
+            tokens = self.count(line)
+            if student_tokens + tokens > student_limit:
+                break
+            kept_courses.append(line)
+            student_tokens += tokens
+        remaining -= student_tokens
+
+        search_tokens = 0
+        search_limit = min(self.search_budget, remaining)
+        kept_chunks = []
+        for chunk in chunks:
+            tokens = self.count(chunk) + (self.count("\n\n") if kept_chunks else 0)
+            if search_tokens + tokens > search_limit:
+                break
+            kept_chunks.append(chunk)
+            search_tokens += tokens
+        remaining -= search_tokens
+
+        search_results = (
+            "\n\n".join(kept_chunks) if kept_chunks else "No relevant documents found."
+        )
+        student_context = student_header + "".join(kept_courses)
+        context_message = {
+            "role": "system",
+            "content": f"{student_context}{SEARCH_LABEL}{search_results}",
+        }
+
+        # Newest history first, until the budget runs out
+        history_tokens = 0
+        kept_history = []
+        for message in reversed(chat_history):
+            tokens = self._message_tokens(message)
+            if history_tokens + tokens > remaining:
+                break
+            kept_history.append(message)
+            history_tokens += tokens
+        kept_history.reverse()
+
+        # Do not start the history with an answer to a question that was left out
+        if kept_history and kept_history[0]["role"] == "assistant":
+            history_tokens -= self._message_tokens(kept_history.pop(0))
+
+        messages = [system_prompt, context_message, *kept_history, user_message]
+
+        # The context message is counted exactly once its final content is known
+        context_tokens = self._message_tokens(context_message)
+        breakdown["student"] = context_tokens - search_tokens
+        breakdown["search"] = search_tokens
+        breakdown["history"] = history_tokens
+        breakdown["total"] = sum(breakdown[section] for section in SECTIONS)
+        breakdown["total"] += TOKENS_PER_REPLY
+        breakdown["budget"] = self.budget
+        breakdown["dropped_courses"] = len(course_lines) - len(kept_courses)
+        breakdown["dropped_chunks"] = len(chunks) - len(kept_chunks)
+        breakdown["dropped_history"] = len(chat_history) - len(kept_history)
+
+        self._observe(breakdown)
+        return messages, breakdown
+
+    def _observe(self, breakdown: dict):
+        with self._lock:
+            self.requests += 1
+            for section in SECTIONS:
+                self.tokens[section] += breakdown[section]
+            for name in self.dropped:
+                self.dropped[name] += breakdown[f"dropped_{name}"]
+            if breakdown["total"] > self.budget:
+                self.over_budget += 1
+
+    def stats(self) -> dict:
+        """Return the average tokens per section and the number of trimmed items."""
+        with self._lock:
+            requests = self.requests
+            return {
+                "budget": self.budget,
+                "requests": requests,
+                "average_tokens": {
+                    section: round(tokens / requests, 1) if requests else 0.0
+                    for section, tokens in self.tokens.items()
+                },
+                "dropped": dict(self.dropped),
+                "over_budget": self.over_budget,
+            }
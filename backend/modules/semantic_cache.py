@@ -0,0 +1,151 @@
+"""
+Cache of chatbot answers, looked up by the meaning of the prompt rather than its
+exact text.
+"""
+
+import threading
+import time
+from typing import Iterable, Optional
+
+import numpy as np
+
+# Scope of answers that may be served to every student
+GLOBAL_SCOPE = None
+
+# Scope ids of the index slots; students have positive ids
+_GLOBAL_ID = -1
+_FREE_ID = -2
+
+
+class SemanticCache:
+    """Thread-safe in-memory index of prompt embeddings and the answers given to them.
+
+    A lookup returns the answer of the most similar stored prompt, by cosine
+    similarity, if it reaches ``threshold``. Every entry belongs to a scope: a
+    student id, or GLOBAL_SCOPE for answers that do not depend on any student,
+    and lookups only see the scopes they ask for. Entries expire after ``ttl``
+    seconds; once ``maxsize`` entries are stored the least recently used one is
+    evicted.
+    """
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 2000, ttl: float = 3600):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        # Allocated on the first store, when the embedding size is known
+        self._vectors = None
+        self._scopes = np.full(maxsize, _FREE_ID, dtype=np.int64)
+        self._expires_at = np.zeros(maxsize)
+        self._last_used = np.zeros(maxsize)
+        self._answers = [None] * maxsize
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _scope_id(scope: Optional[int]) -> int:
+        return _GLOBAL_ID if scope is GLOBAL_SCOPE else int(scope)
+
+    def _best_match(self, vector: np.ndarray, scope_ids, now: float):
+        """Return the slot and similarity of the closest live entry in ``scope_ids``."""
+        if self._vectors is None or vector.shape[0] != self._vectors.shape[1]:
+            return None, 0.0
+
+        live = np.isin(self._scopes, scope_ids) & (self._expires_at > now)
+        if not live.any():
+            return None, 0.0
+
+        similarities = np.where(live, self._vectors @ vector, -np.inf)
+        slot = int(np.argmax(similarities))
+        return slot, float(similarities[slot])
+
+    def lookup(self, embedding, scopes: Iterable[Optional[int]]) -> Optional[str]:
+        """Return the cached answer closest to ``embedding`` within ``scopes``.
+
+        Returns None if no live entry in those scopes is similar enough.
+        """
+        vector = self._normalize(embedding)
+        scope_ids = [self._scope_id(scope) for scope in scopes]
+        now = time.monotonic()
+
+        with self._lock:
+            slot, similarity = self._best_match(vector, scope_ids, now)
+            if slot is None or similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            self._last_used[slot] = now
+            self.hits += 1
+            return self._answers[slot]
+
+    def store(self, embedding, answer: str, scope: Optional[int]):
+        """Cache ``answer`` for the prompt with ``embedding``.
+
+        The entry is only visible to lookups that include ``scope``.
+        """
+        vector = self._normalize(embedding)
+        scope_id = self._scope_id(scope)
+        now = time.monotonic()
+
+        with self._lock:
+            if self._vectors is None or vector.shape[0] != self._vectors.shape[1]:
+                # First store, or the embedding model changed: start over
+                self._vectors = np.zeros((self.maxsize, vector.shape[0]), np.float32)
+                self._scopes.fill(_FREE_ID)
+                self._answers = [None] * self.maxsize
+
+            # Replace a near-duplicate of the same scope rather than storing both
+            slot, similarity = self._best_match(vector, [scope_id], now)
+            if slot is None or similarity < self.threshold:
+                slot = self._free_slot(now)
+
+            self._vectors[slot] = vector
+            self._scopes[slot] = scope_id
+            self._expires_at[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._answers[slot] = answer
+            self.stores += 1
+
+    def _free_slot(self, now: float) -> int:
+        free = np.flatnonzero(self._scopes == _FREE_ID)
+        if free.size:
+            return int(free[0])
+
+        expired = np.flatnonzero(self._expires_at <= now)
+        if expired.size:
+            self.expirations += 1
+            return int(expired[0])
+
+        self.evictions += 1
+        return int(np.argmin(self._last_used))
+
+    def __len__(self):
+        return int(np.count_nonzero(self._scopes != _FREE_ID))
+
+    def stats(self) -> dict:
+        """Return size, hit, miss, store, eviction and expiration counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self),
+                "maxsize": self.maxsize,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
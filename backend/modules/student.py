@@ -1,20 +1,50 @@
-from typing import List, Dict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
 
 
+@dataclass(frozen=True)
+class Program:
+    __slots__ = ("program_id", "name", "european_credits")
+
+    program_id: int
+    name: str
+    european_credits: int
+
+
+@dataclass(frozen=True)
+class Course:
+    __slots__ = (
+        "course_id",
+        "name",
+        "grade",
+        "european_credits",
+        "created_at",
+        "feedback",
+    )
+
+    course_id: int
+    name: str
+    grade: int
+    european_credits: int
+    created_at: Optional[datetime]
+    feedback: Optional[str]
+
+
+@dataclass(frozen=True)
 class Student:
-    def __init__(
-        self,
-        student_id: int,
-        name: str,
-        email: str,
-        courses: List[Dict[str, str]],
-        program: Dict[str, str] = None,
-    ):
-        self.student_id = student_id
-        self.name = name
-        self.email = email
-        self.courses = courses
-        self.program = program or {}
+    """Immutable student record, safe to share between threads and caches."""
+
+    __slots__ = ("student_id", "name", "email", "courses", "program")
+
+    student_id: int
+    name: str
+    email: str
+    courses: Tuple[Course, ...]
+    program: Optional[Program]
 
     def __repr__(self) -> str:
-        return f"Student(id={self.student_id}, name={self.name}, email={self.email}, courses={self.courses}, program={self.program})"
+        return (
+            f"Student(id={self.student_id}, name={self.name}, email={self.email}, "
+            f"courses={len(self.courses)}, program={self.program})"
+        )
@@ -0,0 +1,92 @@
+"""
+DatabaseClient.bulk_load through the SQL Server backend's run_script, on a fake
+connection.
+
+Run from the backend directory with ``python -m unittest discover tests``.
+"""
+
+import unittest
+
+from clients.connection_pool import ConnectionPool
+from clients.database_client import DatabaseClient
+from clients.query_metrics import QueryMetrics
+from clients.storage import SqlServerBackend
+from modules.cache import TTLCache
+
+
+class FakeCursor:
+    """Records the statements it is given, like a pyodbc cursor that returns no rows."""
+
+    def __init__(self, executed):
+        self.executed = executed
+        self.description = None
+        self.rowcount = -1
+        self.fast_executemany = False
+
+    def execute(self, sql, params=()):
+        self.executed.append(("execute", sql))
+        self.rowcount = 2
+
+    def executemany(self, sql, seq_of_params):
+        self.executed.append(("executemany", sql, list(seq_of_params)))
+        self.rowcount = -1
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        cursor = FakeCursor(self.executed)
+        cursor.connection = self
+        return cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BulkLoadSqlServerTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.metrics = QueryMetrics(slow_query_ms=0)
+        self.db = DatabaseClient(
+            backend=SqlServerBackend(),
+            pool=ConnectionPool(lambda: self.conn, max_size=1),
+            settings_cache=TTLCache(ttl=60),
+            usage_recorder=object(),
+            profile_cache=TTLCache(ttl=60),
+            query_metrics=self.metrics,
+            password_hasher=object(),
+        )
+
+    def test_stage_script_runs_on_instrumented_cursor(self):
+        create_stage, insert_stage, resolve = SqlServerBackend.bulk_load["programs"]
+
+        inserted = self.db.bulk_load("programs", [("Physics", 180), ("Law", 180)])
+
+        self.assertEqual(inserted, 2)
+        self.assertEqual(self.conn.executed[0], ("execute", create_stage))
+        self.assertEqual(self.conn.executed[1][:2], ("executemany", insert_stage))
+        self.assertEqual(self.conn.executed[2], ("execute", resolve))
+        self.assertEqual(self.metrics.stats()["bulk_create_stage_programs"]["calls"], 1)
+
+    def test_run_script_without_name_uses_raw_cursor(self):
+        cursor = self.conn.cursor()
+
+        SqlServerBackend().run_script(cursor, "SELECT 1;")
+
+        self.assertEqual(self.conn.executed, [("execute", "SELECT 1;")])
+
+
+if __name__ == "__main__":
+    unittest.main()
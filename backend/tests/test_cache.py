@@ -0,0 +1,65 @@
+"""
+TTLCache expiry and LRU eviction, and cross-process invalidation through a file.
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+from modules.cache import FileInvalidationChannel, TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = TTLCache(ttl=0.05)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=60)
+
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.06)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_sweep_drops_expired_entries(self):
+        cache = TTLCache(ttl=0.01)
+        for key in range(5):
+            cache.set(key, key)
+        time.sleep(0.02)
+
+        self.assertEqual(cache.sweep(), 5)
+        self.assertEqual(len(cache), 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(ttl=60, maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")  # "b" is now the least recently used
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidation_is_broadcast_through_channel(self):
+        path = os.path.join(tempfile.mkdtemp(), "invalidate")
+        local = TTLCache(ttl=60, channel=FileInvalidationChannel(path))
+        remote = TTLCache(ttl=60, channel=FileInvalidationChannel(path))
+        local.set("a", 1)
+        remote.set("a", 1)
+        remote.set("b", 2)
+
+        local.invalidate("a")
+
+        self.assertIsNone(local.get("a"))
+        # Other processes drop all their entries
+        self.assertIsNone(remote.get("a"))
+        self.assertIsNone(remote.get("b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
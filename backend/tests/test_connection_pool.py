@@ -0,0 +1,100 @@
+"""
+ConnectionPool checkout, timeout, recycling and rollback, on SQLite connections.
+"""
+
+import sqlite3
+import time
+import unittest
+
+from clients.connection_pool import ConnectionPool, PoolTimeoutError
+
+
+def connect():
+    return sqlite3.connect(":memory:", check_same_thread=False)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_reuses_idle_connection(self):
+        pool = ConnectionPool(connect, max_size=2)
+
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(pool.stats()["created"], 1)
+        self.assertEqual(pool.stats()["checkouts"], 2)
+
+    def test_checkout_times_out_when_exhausted(self):
+        pool = ConnectionPool(connect, max_size=1, timeout=0.05)
+
+        with pool.connection():
+            with self.assertRaises(PoolTimeoutError):
+                with pool.connection():
+                    pass
+
+        self.assertEqual(pool.stats()["timeouts"], 1)
+        # The slot is still usable after the timeout
+        with pool.connection():
+            pass
+
+    def test_recycles_idle_expired_connection(self):
+        pool = ConnectionPool(connect, max_size=1, max_idle=0.01)
+
+        with pool.connection() as first:
+            pass
+        time.sleep(0.02)
+        with pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertEqual(pool.stats()["recycled"], 1)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_discards_connection_that_fails_ping(self):
+        pool = ConnectionPool(connect, max_size=1, ping_interval=0)
+
+        with pool.connection() as first:
+            first.close()
+        with pool.connection() as second:
+            second.execute("SELECT 1;")
+
+        self.assertIsNot(first, second)
+        self.assertEqual(pool.stats()["discarded"], 1)
+
+    def test_rolls_back_and_returns_connection_on_error(self):
+        pool = ConnectionPool(connect, max_size=1)
+        with pool.connection() as conn:
+            conn.execute("CREATE TABLE t (x INTEGER);")
+            conn.commit()
+
+        with self.assertRaises(RuntimeError):
+            with pool.connection() as conn:
+                conn.execute("INSERT INTO t VALUES (1);")
+                raise RuntimeError("boom")
+
+        with pool.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM t;").fetchone()[0], 0)
+        self.assertEqual(pool.stats()["in_use"], 0)
+
+    def test_returns_connection_when_generator_is_closed(self):
+        pool = ConnectionPool(connect, max_size=1, timeout=0.05)
+
+        def rows():
+            with pool.connection():
+                yield 1
+                yield 2
+
+        for _ in range(3):
+            generator = rows()
+            next(generator)
+            generator.close()
+
+        with pool.connection():
+            pass
+        self.assertEqual(pool.stats()["timeouts"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+"""
+DatabaseClient on the SQLite backend: migrations, token reservations and
+registration races.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from clients import schema
+from clients.connection_pool import ConnectionPool
+from clients.database_client import DatabaseClient
+from clients.query_metrics import QueryMetrics
+from clients.storage import SqliteBackend
+from clients.usage_recorder import UsageRecorder
+from modules.cache import TTLCache
+
+
+class SqliteDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = SqliteBackend(os.path.join(self.directory, "test.db"))
+        self.pool = ConnectionPool(self.backend.connect, max_size=8)
+        self.recorder = UsageRecorder(
+            lambda records: self.db.write_token_usage(records), flush_interval=3600
+        )
+        self.db = DatabaseClient(
+            backend=self.backend,
+            pool=self.pool,
+            settings_cache=TTLCache(ttl=60),
+            usage_recorder=self.recorder,
+            profile_cache=TTLCache(ttl=60),
+            query_metrics=QueryMetrics(slow_query_ms=0),
+            password_hasher=object(),
+        )
+        self.applied = self.migrate()
+
+    def tearDown(self):
+        self.recorder.close()
+        self.pool.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def migrate(self) -> list:
+        with self.pool.connection() as conn:
+            return schema.apply_migrations(conn, self.backend)
+
+    def query(self, sql: str, params=()):
+        with self.pool.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+
+class MigrationTest(SqliteDatabaseTest):
+    def test_migrations_apply_once(self):
+        versions = [version for version, _, _ in self.backend.migrations]
+        self.assertEqual(self.applied, versions)
+
+        self.assertEqual(self.migrate(), [])
+        self.assertEqual(
+            self.query("SELECT version FROM SchemaVersion ORDER BY version;"),
+            [(version,) for version in versions],
+        )
+
+
+class TokenReservationTest(SqliteDatabaseTest):
+    def setUp(self):
+        super().setUp()
+        self.student_id, _ = self.db.get_or_create_student("Ada", "ada@uva.nl")
+
+    def reservations(self):
+        return self.query("SELECT id, tokens FROM TokenReservation;")
+
+    def test_commit_settles_reservation_on_flush(self):
+        reservation_id = self.db.reserve_tokens(self.student_id, 100)
+        self.assertIsNotNone(reservation_id)
+        self.assertEqual(self.db.get_quota_snapshot(self.student_id)["reserved"], 100)
+
+        self.db.commit_token_reservation(reservation_id, self.student_id, 40)
+        # Until the flush the reservation still holds the quota
+        self.assertEqual(self.db.get_quota_snapshot(self.student_id)["usage"], 100)
+
+        self.recorder.flush()
+
+        self.assertEqual(self.reservations(), [])
+        quota = self.db.get_quota_snapshot(self.student_id)
+        self.assertEqual(quota["usage"], 40)
+        self.assertEqual(quota["reserved"], 0)
+
+    def test_reservations_cannot_exceed_limit(self):
+        self.db.set_global_token_limit(150)
+
+        self.assertIsNotNone(self.db.reserve_tokens(self.student_id, 100))
+        self.assertIsNone(self.db.reserve_tokens(self.student_id, 100))
+
+    def test_release_gives_back_quota(self):
+        self.db.set_global_token_limit(150)
+        reservation_id = self.db.reserve_tokens(self.student_id, 100)
+
+        self.db.release_token_reservation(reservation_id)
+
+        self.assertIsNotNone(self.db.reserve_tokens(self.student_id, 100))
+
+    def test_expired_reservations_are_removed_on_write(self):
+        self.db.set_global_token_limit(150)
+        with mock.patch.dict(os.environ, {"reservation-ttl": "-1"}):
+            self.db.reserve_tokens(self.student_id, 100)
+        live_id = self.db.reserve_tokens(self.student_id, 100)
+
+        # An expired reservation no longer holds any quota
+        self.assertIsNotNone(live_id)
+
+        self.db.add_token_usage(self.student_id, 5)
+        self.recorder.flush()
+
+        self.assertEqual(self.reservations(), [(live_id, 100)])
+
+    def test_usage_report_survives_failed_flush(self):
+        self.db.add_token_usage(self.student_id, 5)
+        self.recorder.flush()
+        self.db.add_token_usage(self.student_id, 7)
+
+        with mock.patch.object(
+            self.db, "write_token_usage", side_effect=sqlite3.OperationalError
+        ):
+            usage = self.db.get_monthly_token_usage()
+
+        # Only the persisted usage is reported; the rest stays buffered
+        self.assertEqual(usage[0]["tokens_used"], 5)
+        self.assertEqual(self.recorder.stats()["pending_records"], 1)
+
+
+class GetOrCreateStudentTest(SqliteDatabaseTest):
+    def test_existing_student_is_returned(self):
+        created = self.db.get_or_create_student("Ada", "ada@uva.nl")
+        existing = self.db.get_or_create_student("Other", "ada@uva.nl")
+
+        self.assertEqual(created, (created[0], True))
+        self.assertEqual(existing, (created[0], False))
+
+    def test_concurrent_calls_create_one_student(self):
+        barrier = threading.Barrier(8)
+        results = []
+
+        def register():
+            barrier.wait()
+            results.append(self.db.get_or_create_student("Ada", "ada@uva.nl"))
+
+        threads = [threading.Thread(target=register) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len({student_id for student_id, _ in results}), 1)
+        self.assertEqual(sum(created for _, created in results), 1)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM dbo.Student;"), [(1,)])
+
+    def test_lost_insert_race_returns_existing_student(self):
+        student_id, _ = self.db.get_or_create_student("Ada", "ada@uva.nl")
+
+        # A plain insert fails on the unique email, as when another insert won
+        self.backend.get_or_create_student = """
+        INSERT INTO dbo.Student (name, email, password) VALUES (?, ?, ?)
+        RETURNING id, 1;
+        """
+
+        self.assertEqual(
+            self.db.get_or_create_student("Ada", "ada@uva.nl"), (student_id, False)
+        )
+
+    def test_other_errors_are_raised(self):
+        self.db.get_or_create_student("Ada", "ada@uva.nl")
+        self.backend.get_or_create_student = "INSERT INTO Missing VALUES (?, ?, ?);"
+
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.get_or_create_student("Ada", "ada@uva.nl")
+
+
+if __name__ == "__main__":
+    unittest.main()